@@ -0,0 +1,213 @@
+"""
+Локальный архив разговоров: метаданные, summary и реплики транскрипта в сжатом JSON Lines.
+
+    python archive.py query --agent agent_1 --since 2024-01-01 --until 2024-04-01 --contains "возврат"
+    python archive.py stats --since 2024-01-01
+
+Включается переменной SYNC_ARCHIVE_DIR. Раскладка: <dir>/<агент>/<YYYY-MM-DD>.jsonl.zst (день — дата
+начала разговора по UTC). Каждая запись дописывается отдельным zstd-фреймом, поэтому файлы только
+растут и остаются читаемыми после аварийного завершения. Без пакета zstandard пишется .jsonl.gz.
+Повторно обработанный разговор (например, после ошибки записи в Doc) появляется в архиве ещё раз;
+при чтении остаётся последняя версия.
+"""
+import argparse
+import atexit
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:  # необязательная зависимость: pip install zstandard
+    zstandard = None
+
+ARCHIVE_DIR = os.getenv('SYNC_ARCHIVE_DIR')
+ARCHIVE_SUFFIXES = ('.jsonl.zst', '.jsonl.gz')
+
+
+def archive_record(agent_name, details, audio_link):
+    metadata = details.get("metadata") or {}
+    return {
+        "conversation_id": details.get("conversation_id"),
+        "agent_id": details.get("agent_id"),
+        "agent": agent_name,
+        "start_time_unix_secs": metadata.get("start_time_unix_secs"),
+        "call_duration_secs": metadata.get("call_duration_secs"),
+        "status": details.get("status"),
+        "summary": ((details.get("analysis") or {}).get("transcript_summary") or "").strip(),
+        "audio_link": audio_link,
+        "transcript": [
+            {"role": turn.get("role"), "message": turn.get("message"), "time_in_call_secs": turn.get("time_in_call_secs")}
+            for turn in details.get("transcript") or []
+        ],
+        "archived_at": int(time.time()),
+    }
+
+
+def _day(start_ts):
+    if not start_ts:
+        return "unknown"
+    return datetime.fromtimestamp(start_ts, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+class ArchiveWriter:
+    def __init__(self, root):
+        self.root = root
+        self.suffix = ARCHIVE_SUFFIXES[0] if zstandard else ARCHIVE_SUFFIXES[1]
+        self.files = {}
+        self.lock = threading.Lock()
+        # ZstdCompressor нельзя использовать из нескольких потоков одновременно — у каждого потока свой
+        self._local = threading.local()
+
+    def _compress(self, data):
+        if zstandard is None:
+            return gzip.compress(data)
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=6)
+        return compressor.compress(data)
+
+    def write(self, record):
+        path = os.path.join(self.root, record["agent"], _day(record["start_time_unix_secs"]) + self.suffix)
+        frame = self._compress(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+        with self.lock:
+            f = self.files.get(path)
+            if f is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = self.files[path] = open(path, 'ab')
+            f.write(frame)
+            f.flush()
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+
+
+class NullArchiveWriter:
+    """Архив выключен (SYNC_ARCHIVE_DIR не задан)."""
+
+    def write(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_archive_writer(root=None):
+    root = ARCHIVE_DIR if root is None else root
+    if not root:
+        return NullArchiveWriter()
+    writer = ArchiveWriter(root)
+    atexit.register(writer.close)
+    return writer
+
+
+# --- Чтение ---
+
+def _open_partition(path):
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"Для чтения {path} нужен пакет zstandard")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return gzip.open(path, 'rt', encoding='utf-8')
+
+
+def partitions(root, agent=None, since=None, until=None):
+    """Файлы архива, пересекающиеся с [since, until) — отбор по имени, без чтения содержимого."""
+    since_day = _day(since) if since else None
+    until_day = _day(until - 1) if until else None
+    if not os.path.isdir(root):
+        return []
+    agents = [agent] if agent else sorted(os.listdir(root))
+    found = []
+    for agent_name in agents:
+        agent_dir = os.path.join(root, agent_name)
+        if not os.path.isdir(agent_dir):
+            continue
+        for name in sorted(os.listdir(agent_dir)):
+            suffix = next((s for s in ARCHIVE_SUFFIXES if name.endswith(s)), None)
+            if suffix is None:
+                continue
+            day = name[:-len(suffix)]
+            if day != "unknown" and ((since_day and day < since_day) or (until_day and day > until_day)):
+                continue
+            found.append(os.path.join(agent_dir, name))
+    return found
+
+
+def iter_conversations(root=None, agent=None, since=None, until=None, contains=None):
+    """
+    Разговоры из архива в порядке разделов (агент, день). since/until — unix-время начала разговора,
+    contains — подстрока (без учёта регистра) в summary или репликах. Дубликаты одного разговора
+    внутри дня схлопываются в последнюю версию.
+    """
+    root = root or ARCHIVE_DIR
+    needle = contains.lower() if contains else None
+    for path in partitions(root, agent, since, until):
+        latest = {}
+        with _open_partition(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                latest[record.get("conversation_id")] = record
+        for record in latest.values():
+            start_ts = record.get("start_time_unix_secs") or 0
+            if (since and start_ts < since) or (until and start_ts >= until):
+                continue
+            if needle and needle not in record.get("summary", "").lower() and not any(
+                needle in (turn.get("message") or "").lower() for turn in record.get("transcript", [])
+            ):
+                continue
+            yield record
+
+
+def parse_time(value):
+    """Дата YYYY-MM-DD (UTC) или unix-время в секундах — для --since/--until в archive, search_index и backfill."""
+    if value.isdigit():
+        return int(value)
+    return int(datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['query', 'stats'])
+    parser.add_argument('--dir', default=ARCHIVE_DIR, help="каталог архива (по умолчанию SYNC_ARCHIVE_DIR)")
+    parser.add_argument('--agent', help="имя агента, например agent_1")
+    parser.add_argument('--since', type=parse_time, help="YYYY-MM-DD или unix-время")
+    parser.add_argument('--until', type=parse_time, help="YYYY-MM-DD или unix-время (не включительно)")
+    parser.add_argument('--contains', help="подстрока в summary или транскрипте")
+    args = parser.parse_args(argv)
+    if not args.dir:
+        sys.exit("Каталог архива не задан: укажите --dir или SYNC_ARCHIVE_DIR.")
+
+    records = iter_conversations(args.dir, args.agent, args.since, args.until, args.contains)
+    if args.command == 'query':
+        for record in records:
+            print(json.dumps(record, ensure_ascii=False))
+        return
+
+    per_agent = Counter()
+    seconds = Counter()
+    turns = 0
+    for record in records:
+        per_agent[record["agent"]] += 1
+        seconds[record["agent"]] += record.get("call_duration_secs") or 0
+        turns += len(record.get("transcript", []))
+    for agent_name, count in sorted(per_agent.items()):
+        print(f"{agent_name}: {count} разговоров, {seconds[agent_name] / 3600:.1f} ч")
+    print(f"Всего: {sum(per_agent.values())} разговоров, {turns} реплик.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+
+import aiohttp
+
+from elevenlabs_client import (
+    API_BASE_URL, CONNECT_TIMEOUT, POOL_SIZE, READ_TIMEOUT, ListingError,
+    listing_params, report_listing, route_listing_page,
+)
+from retry import async_request_with_retry
+import run_report
+from run_report import add_bytes, agent_context, instrumented
+from state_store import agent_lock, open_state_store
+from sync_engine import (
+    AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES, DOC_BATCH_MODE, ELEVENLABS_API_KEY,
+    append_doc_entry, close_details_source, configured_agents, get_details_source, get_google_services, get_thread_drive_service,
+    known_audio_link, listing_mark, listing_start_after, load_agents_from_env, make_entry, note_listing_time,
+    save_high_water_mark, select_new_conversations, upload_audio, write_doc_entries,
+)
+
+# Асинхронный режим: все агенты и разговоры в одном цикле событий.
+# Результат (содержимое Doc, обработанные ID, отметки) совпадает с sync_engine.main().
+#
+# Сколько разговоров одновременно находится на каждом этапе. Слот audio занят от начала скачивания
+# до конца загрузки на Drive, поэтому в памяти не больше AUDIO_CONCURRENCY аудиобуферов.
+DETAILS_CONCURRENCY = int(os.getenv('SYNC_ASYNC_DETAILS_CONCURRENCY', '16'))
+AUDIO_CONCURRENCY = int(os.getenv('SYNC_ASYNC_AUDIO_CONCURRENCY', '8'))
+UPLOAD_CONCURRENCY = int(os.getenv('SYNC_ASYNC_UPLOAD_CONCURRENCY', '8'))
+# Сколько разговоров агента запущено наперёд: задачи создаются окном, а не на весь список сразу
+ASYNC_WINDOW = max(int(os.getenv('SYNC_ASYNC_WINDOW', '32')), 1)
+
+_NETWORK_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class AsyncElevenLabsClient:
+    """Асинхронный двойник ElevenLabsClient на aiohttp с тем же пулом, таймаутами и повторами."""
+
+    def __init__(self, api_key, base_url=API_BASE_URL, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.base_url = base_url
+        self.session = aiohttp.ClientSession(
+            headers={"xi-api-key": api_key or "", "Accept-Encoding": "gzip, deflate"},
+            connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=30),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def _get(self, path, **kwargs):
+        url = f"{self.base_url}{path}"
+        return await async_request_with_retry(
+            'elevenlabs', lambda: self.session.get(url, **kwargs), _NETWORK_ERRORS,
+        )
+
+    @instrumented('list')
+    async def get_new_conversations(self, agent_ids, start_after=None):
+        agent_conversations = {agent_id: [] for agent_id in agent_ids}
+        if not agent_conversations:
+            print("Ошибка: ID агентов не указаны.")
+            return agent_conversations
+
+        params = listing_params(agent_conversations, start_after)
+        pages = 0
+        while True:
+            try:
+                response = await self._get("/convai/conversations", params=params)
+                async with response:
+                    response.raise_for_status()
+                    data = await response.json()
+                pages += 1
+                if not route_listing_page(agent_conversations, data, start_after):
+                    break
+                params["cursor"] = data.get("next_cursor")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Ошибка при запросе списка разговоров: {e!r}")
+                raise ListingError(f"список прерван на странице {pages + 1}: {e!r}") from e
+
+        report_listing(agent_conversations, pages)
+        return agent_conversations
+
+    @instrumented('details')
+    async def get_conversation_details(self, conversation_id):
+        try:
+            response = await self._get(f"/convai/conversations/{conversation_id}")
+            async with response:
+                if response.status != 200:
+                    print(f"Ошибка получения деталей для {conversation_id}. Статус: {response.status}. Ответ: {await response.text()}")
+                    return None
+                return await response.json()
+        except Exception as e:
+            print(f"Критическая ошибка при запросе деталей для {conversation_id}: {e!r}")
+            return None
+
+    @instrumented('audio')
+    async def download_conversation_audio_stream(self, conversation_id, chunk_size, spool_max_bytes):
+        try:
+            response = await self._get(f"/convai/conversations/{conversation_id}/audio")
+            async with response:
+                if response.status != 200:
+                    print(f"Ошибка скачивания аудио для {conversation_id}. Статус: {response.status}. Ответ: {await response.text()}")
+                    return None
+
+                buffer = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+                try:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        buffer.write(chunk)
+                    size = buffer.tell()
+                    buffer.seek(0)
+                    add_bytes(size)
+                except BaseException:
+                    buffer.close()
+                    raise
+            print(f"Аудио для {conversation_id} скачано в буфер ({size} байт).")
+            return buffer
+        except Exception as e:
+            print(f"Критическая ошибка при скачивании аудио для {conversation_id}: {e!r}")
+            return None
+
+
+def _upload_in_thread(audio, conv_id, folder_id):
+    # Клиенты googleapiclient синхронные и не потокобезопасные — у каждого потока свой
+    return upload_audio(get_thread_drive_service(), audio, conv_id, folder_id)
+
+
+async def fetch_conversation_async(client, agent, conv_id, semaphores):
+    """Асинхронный аналог sync_engine.fetch_conversation; каждый этап ограничен своим семафором."""
+    print(f"\n--- [{agent.name}] Обработка новой записи: {conv_id} ---")
+    # Предзагрузка не нужна: детали всех разговоров и так запрашиваются одновременно.
+    # Дисковый кэш деталей, архив, поисковый индекс и хранилище состояния трогаются только из потоков:
+    # медленная запись на диск не должна останавливать цикл событий со всеми разговорами
+    details_source = get_details_source()
+    details = await asyncio.to_thread(details_source.cached, conv_id)
+    if details is None:
+        async with semaphores['details']:
+            fetched = await client.get_conversation_details(conv_id)
+        details = await asyncio.to_thread(details_source.store, conv_id, fetched)
+    if not details:
+        print(f"Не удалось получить детали для {conv_id}. Пропускаем.")
+        return None
+
+    # Кэш проверяется в потоке: при SYNC_DRIVE_LOOKUP=1 это запрос к Drive
+    async with semaphores['upload']:
+        audio_link = await asyncio.to_thread(known_audio_link, agent, conv_id)
+    if audio_link:
+        return await asyncio.to_thread(make_entry, agent, details, audio_link)
+
+    # Слот audio держится до конца загрузки: скачанный буфер не ждёт Drive вне лимита
+    async with semaphores['audio']:
+        audio = await client.download_conversation_audio_stream(conv_id, AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES)
+        if not audio:
+            print(f"Не удалось скачать аудио для {conv_id}. Пропускаем.")
+            return None
+        try:
+            async with semaphores['upload']:
+                audio_link = await asyncio.to_thread(_upload_in_thread, audio, conv_id, agent.drive_folder_id)
+        finally:
+            audio.close()
+
+    if not audio_link:
+        return None
+    return await asyncio.to_thread(make_entry, agent, details, audio_link)
+
+
+async def process_agent_async(client, agent, conversations, docs_service, semaphores, doc_batch=None):
+    """
+    Загрузка разговоров агента идёт параллельно, а записи в Google Doc — строго по времени,
+    в том же порядке и с теми же отметками в хранилище, что и в sync_engine.process_agent.
+    """
+    doc_batch = DOC_BATCH_MODE if doc_batch is None else doc_batch
+    store = await asyncio.to_thread(open_state_store, agent)
+    try:
+        with agent_context(agent.name):
+            return await _process_agent_async(client, agent, conversations, docs_service, semaphores, doc_batch, store)
+    finally:
+        await asyncio.to_thread(store.close)
+
+
+async def _process_agent_async(client, agent, conversations, docs_service, semaphores, doc_batch, store):
+    new_ids, done_ids = await asyncio.to_thread(select_new_conversations, agent, conversations, store)
+    if not conversations:
+        await asyncio.to_thread(save_high_water_mark, agent, conversations, done_ids)
+        return 0
+
+    # Окно из не более чем ASYNC_WINDOW задач: следующая создаётся, когда самая ранняя забрана
+    remaining = iter(new_ids)
+    window = collections.deque()
+
+    def fill_window():
+        while len(window) < ASYNC_WINDOW:
+            conv_id = next(remaining, None)
+            if conv_id is None:
+                return
+            window.append((conv_id, asyncio.create_task(fetch_conversation_async(client, agent, conv_id, semaphores))))
+
+    pending_doc_entries = []
+    try:
+        fill_window()
+        while window:
+            conv_id, task = window.popleft()
+            entry = await task
+            fill_window()
+            if not entry:
+                await asyncio.to_thread(store.mark_failed, conv_id, "fetch")
+                continue
+            if doc_batch:
+                pending_doc_entries.append((conv_id, entry))
+                continue
+            # Один общий Docs-клиент на все агенты, поэтому записи в Doc идут по одной
+            async with semaphores['docs']:
+                appended = await asyncio.to_thread(append_doc_entry, docs_service, agent, entry)
+            if not appended:
+                await asyncio.to_thread(store.mark_failed, conv_id, "doc")
+                continue
+            await asyncio.to_thread(store.mark_processed, [conv_id])
+            done_ids.add(conv_id)
+    finally:
+        for _, task in window:
+            task.cancel()
+
+    if pending_doc_entries:
+        async with semaphores['docs']:
+            written_ids = await asyncio.to_thread(
+                write_doc_entries, docs_service, agent, pending_doc_entries,
+            )
+        await asyncio.to_thread(store.mark_processed, written_ids)
+        done_ids.update(written_ids)
+
+    if not new_ids:
+        print(f"[{agent.name}] Новых записей для обработки не найдено.")
+
+    await asyncio.to_thread(save_high_water_mark, agent, conversations, done_ids)
+    return len(new_ids)
+
+
+async def run_async(agents, docs_service):
+    semaphores = {
+        'details': asyncio.Semaphore(DETAILS_CONCURRENCY),
+        'audio': asyncio.Semaphore(AUDIO_CONCURRENCY),
+        'upload': asyncio.Semaphore(UPLOAD_CONCURRENCY),
+        'docs': asyncio.Semaphore(1),
+    }
+    pool_size = max(POOL_SIZE, DETAILS_CONCURRENCY + AUDIO_CONCURRENCY)
+    client = AsyncElevenLabsClient(ELEVENLABS_API_KEY, pool_size=pool_size)
+    try:
+        marks = [listing_mark(agent) for agent in agents]
+        listed_at = int(time.time())
+        conversations_by_agent = await client.get_new_conversations(
+            [agent.agent_id for agent in agents], start_after=listing_start_after(marks)
+        )
+        note_listing_time(agents, listed_at)
+        await asyncio.gather(*(
+            process_agent_async(client, agent, conversations_by_agent.get(agent.agent_id, []), docs_service, semaphores)
+            for agent in agents
+        ))
+    finally:
+        await client.close()
+
+
+def main(agents=None):
+    print("Начало работы скрипта (асинхронный режим)...")
+    agents = load_agents_from_env() if agents is None else configured_agents(agents)
+    if not agents:
+        sys.exit("Не настроено ни одного агента.")
+
+    docs_service, drive_service = get_google_services()
+    if not all([docs_service, drive_service]):
+        sys.exit("Не удалось подключиться к сервисам Google.")
+
+    try:
+        with ExitStack() as stack:
+            for agent in agents:
+                stack.enter_context(agent_lock(agent))
+            asyncio.run(run_async(agents, docs_service))
+    except ListingError as e:
+        sys.exit(f"Не удалось получить список разговоров: {e}")
+
+    close_details_source()
+    run_report.finish_run()
+    print("Работа скрипта завершена.")
+
+if __name__ == '__main__':
+    main()
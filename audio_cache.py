@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+
+# Кэш загруженного аудио: conversation_id и sha256 записи -> ссылка на файл в Drive.
+# Если прошлый запуск загрузил MP3, но упал до отметки разговора (например, на записи в Google Doc),
+# следующий запуск берёт ссылку отсюда и не качает и не загружает файл заново — дублей в Drive нет.
+# Формат — JSON Lines, только дозапись (как agent_N_processed_ids.txt), файл коммитится вместе с состоянием.
+AUDIO_CACHE_PATH = os.getenv('SYNC_AUDIO_CACHE', 'audio_cache.jsonl')
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def content_sha256(fileobj):
+    """sha256 содержимого файлового объекта; позиция возвращается в начало."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(_HASH_CHUNK), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return content_sha256(f)
+
+
+class AudioCache:
+    def __init__(self, path):
+        self.path = path
+        self.by_conversation = {}
+        self.by_hash = {}
+        self.lock = threading.Lock()
+        self._file = None
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        self._index(json.loads(line))
+                    except ValueError:
+                        # Оборванная последняя строка после падения процесса
+                        continue
+
+    def _index(self, record):
+        if record.get('conversation_id'):
+            self.by_conversation[record['conversation_id']] = record
+        if record.get('sha256'):
+            self.by_hash[record['sha256']] = record
+
+    def link_for_conversation(self, conversation_id):
+        with self.lock:
+            record = self.by_conversation.get(conversation_id)
+            return record and record.get('link')
+
+    def link_for_hash(self, sha256):
+        with self.lock:
+            record = self.by_hash.get(sha256)
+            return record and record.get('link')
+
+    def put(self, conversation_id, link, sha256=None, file_id=None):
+        record = {'conversation_id': conversation_id, 'sha256': sha256, 'file_id': file_id, 'link': link}
+        with self.lock:
+            if self.by_conversation.get(conversation_id) == record:
+                return
+            if self._file is None:
+                self._file = open(self.path, 'a', buffering=1)
+            self._file.write(json.dumps(record) + '\n')
+            self._index(record)
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class NullAudioCache:
+    """Кэш выключен (SYNC_AUDIO_CACHE='')."""
+
+    def link_for_conversation(self, conversation_id):
+        return None
+
+    def link_for_hash(self, sha256):
+        return None
+
+    def put(self, conversation_id, link, sha256=None, file_id=None):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_audio_cache(path=None):
+    path = AUDIO_CACHE_PATH if path is None else path
+    return AudioCache(path) if path else NullAudioCache()
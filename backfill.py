@@ -0,0 +1,151 @@
+"""
+Исторический backfill: разговоры одного агента за период, порциями с контрольными точками.
+
+    python backfill.py --agent 2 --since 2024-01-01 --until 2024-07-01 --rate 0.5
+    python backfill.py --agent 2 --since 2024-01-01 --until 2024-07-01 --doc-id <ID нового документа>
+
+После каждой порции прогресс сохраняется в backfill_<агент>_<since>_<until>.json; повторный запуск
+с теми же аргументами продолжает с первого необработанного разговора. Отметка в контрольной точке
+двигается так же, как high-water mark: только по непрерывному префиксу, так что неудачные
+разговоры будут повторены при следующем запуске.
+
+Порция обрабатывается под блокировкой агента (state_store.agent_lock), которую держит и обычная
+синхронизация, а уже обработанные ID отбрасываются внутри блокировки — дублей в Doc не будет.
+Между порциями блокировка снята, и --rate (разговоров в секунду) оставляет место cron-запускам.
+
+Записи вставляются в начало Doc, поэтому для пересборки документа удобнее отдельный --doc-id.
+У такого запуска отдельные цепочка документов (backfill_<агент>_<doc-id>_docs.json), список обработанных ID
+(backfill_<агент>_<doc-id>_processed_ids.txt или свой ключ в SQLite), блокировка и контрольная точка:
+разговоры, уже записанные в основной Doc, попадут и в новый, а основная синхронизация не пропустит
+разговоры, записанные пересборкой.
+"""
+import argparse
+import dataclasses
+import sys
+import time
+
+from archive import parse_time
+from elevenlabs_client import ListingError
+import run_report
+from sync_engine import (
+    DOC_BATCH_MODE, SYNC_WORKERS, advance_high_water_mark, agent_from_env, close_details_source, get_details_source,
+    get_elevenlabs_client, get_google_services, load_agent_state, process_conversation_ids, save_agent_state,
+)
+
+BACKFILL_CHUNK_SIZE = 50
+BACKFILL_RATE = 0.5
+
+
+def checkpoint_path(agent, since, until, doc_id=None):
+    suffix = f"_{doc_id}" if doc_id else ""
+    return f"backfill_{agent.name}{suffix}_{since}_{until}.json"
+
+
+def rebuild_agent(agent, doc_id):
+    """Агент для пересборки в другой Doc: своя цепочка документов и своё состояние, отдельные от основных."""
+    base = f"backfill_{agent.name}_{doc_id}"
+    return dataclasses.replace(
+        agent, doc_id=doc_id, doc_index_file=f"{base}_docs.json",
+        processed_ids_file=f"{base}_processed_ids.txt", state_file=f"{base}_state.json",
+        state_name=f"{agent.name}:{doc_id}",
+    )
+
+
+def run_backfill(agent, since, until, docs_service, chunk_size=BACKFILL_CHUNK_SIZE, rate=BACKFILL_RATE,
+                 workers=SYNC_WORKERS, doc_batch=DOC_BATCH_MODE, doc_id=None):
+    path = checkpoint_path(agent, since, until, doc_id)
+    checkpoint = load_agent_state(path) or {
+        "agent_id": agent.agent_id, "since": since, "until": until,
+        "mark": 0, "last_conversation_id": None, "processed": 0, "chunks": 0, "finished": False,
+    }
+    if checkpoint["finished"]:
+        print(f"[{agent.name}] Backfill {since}..{until} уже завершён ({path}).")
+        return checkpoint
+    if checkpoint["mark"]:
+        print(f"[{agent.name}] Продолжаем backfill с отметки {checkpoint['mark']} ({checkpoint['last_conversation_id']}).")
+
+    conversations = get_elevenlabs_client().get_new_conversations(
+        [agent.agent_id], start_after=max(since, checkpoint["mark"]), end_before=until,
+    )[agent.agent_id]
+    conversations.sort(key=lambda c: c.get("start_time_unix_secs", 0))
+    listing_ids = [conv.get('conversation_id') for conv in conversations if conv.get('conversation_id')]
+    get_details_source().remember_listing(conversations)
+    print(f"[{agent.name}] К обработке в периоде: {len(listing_ids)} разговоров (до фильтра по обработанным).")
+
+    done_ids = set()
+    for offset in range(0, len(listing_ids), chunk_size):
+        chunk = listing_ids[offset:offset + chunk_size]
+        started = time.monotonic()
+        new_ids, chunk_done_ids = process_conversation_ids(agent, chunk, docs_service, workers, doc_batch)
+        done_ids.update(chunk_done_ids)
+
+        written = sum(1 for conv_id in new_ids if conv_id in done_ids)
+        mark, last_conversation_id = advance_high_water_mark(
+            conversations, done_ids, checkpoint["mark"], checkpoint["last_conversation_id"],
+        )
+        checkpoint.update(
+            mark=mark, last_conversation_id=last_conversation_id, processed=checkpoint["processed"] + written,
+            chunks=checkpoint["chunks"] + 1, updated_at=int(time.time()),
+        )
+        save_agent_state(path, checkpoint)
+        print(
+            f"[{agent.name}] Порция {checkpoint['chunks']}: записано {written} из {len(new_ids)} новых, "
+            f"просмотрено {offset + len(chunk)}/{len(listing_ids)}, отметка {mark}."
+        )
+
+        # Порция из n разговоров занимает не меньше n / rate секунд; на паузе агент свободен для cron
+        if rate > 0 and offset + chunk_size < len(listing_ids):
+            wait = len(new_ids) / rate - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+
+    checkpoint["finished"] = done_ids.issuperset(listing_ids)
+    save_agent_state(path, checkpoint)
+    if checkpoint["finished"]:
+        print(f"[{agent.name}] Backfill {since}..{until} завершён: записано {checkpoint['processed']}.")
+    else:
+        print(f"[{agent.name}] Backfill не завершён: есть неудачные разговоры, запустите ещё раз.")
+    return checkpoint
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agent', required=True, help="номер агента N (переменные AGENT_N_*)")
+    parser.add_argument('--since', required=True, type=parse_time, help="начало периода: YYYY-MM-DD или unix-время")
+    parser.add_argument('--until', required=True, type=parse_time, help="конец периода (не включительно)")
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help="разговоров в порции")
+    parser.add_argument('--rate', type=float, default=BACKFILL_RATE, help="разговоров в секунду, 0 — без ограничения")
+    parser.add_argument('--workers', type=int, default=SYNC_WORKERS)
+    parser.add_argument('--doc-batch', action='store_true', help="писать порцию в Doc пачками batchUpdate")
+    parser.add_argument('--doc-id', help="писать в другой Google Doc (например, при пересборке документа)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.since >= args.until:
+        sys.exit("Начало периода должно быть раньше конца.")
+    agent = agent_from_env(args.agent)
+    if not agent.agent_id:
+        sys.exit(f"ID агента {args.agent} не указан.")
+    if args.doc_id:
+        agent = rebuild_agent(agent, args.doc_id)
+
+    docs_service, drive_service = get_google_services()
+    if not all([docs_service, drive_service]):
+        sys.exit("Не удалось подключиться к сервисам Google.")
+
+    print(f"Начало backfill для {agent.name}: {args.since}..{args.until}...")
+    try:
+        run_backfill(
+            agent, args.since, args.until, docs_service, chunk_size=args.chunk_size, rate=args.rate,
+            workers=max(args.workers, 1), doc_batch=args.doc_batch or DOC_BATCH_MODE, doc_id=args.doc_id,
+        )
+    except ListingError as e:
+        sys.exit(f"Не удалось получить список разговоров: {e}")
+    close_details_source()
+    run_report.finish_run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+# Локальные заменители ElevenLabs и Google для бенчмарков: ничего не уходит в сеть и не тратит квоты.
+
+
+def make_conversations(count, agent_ids, start=1700000000, step=60):
+    """Список разговоров в порядке API (от новых к старым), агенты чередуются."""
+    conversations = [
+        {
+            "conversation_id": f"conv_{i:08d}",
+            "agent_id": agent_ids[i % len(agent_ids)],
+            "start_time_unix_secs": start + i * step,
+            "call_duration_secs": 60,
+            "status": "done",
+        }
+        for i in range(count)
+    ]
+    conversations.reverse()
+    return conversations
+
+
+def make_details(conversation, turns=6):
+    conv_id = conversation["conversation_id"]
+    return {
+        "conversation_id": conv_id,
+        "agent_id": conversation["agent_id"],
+        "metadata": {"start_time_unix_secs": conversation["start_time_unix_secs"]},
+        "analysis": {"transcript_summary": f"Клиент спрашивал про заказ {conv_id}."},
+        "transcript": [
+            {"role": "agent" if i % 2 == 0 else "user", "message": f"Реплика {i} в разговоре {conv_id}."}
+            for i in range(turns)
+        ],
+    }
+
+
+class FakeElevenLabsServer:
+    """
+    HTTP-сервер с эндпоинтами /v1/convai/conversations, /conversations/{id} и /conversations/{id}/audio.
+    latency — задержка ответа в секундах, error_rate — доля ответов 503, audio_size — байт на запись.
+    """
+
+    def __init__(self, conversations, latency=0.0, error_rate=0.0, audio_size=256 * 1024, turns=6, seed=0):
+        self.conversations = conversations
+        self.by_id = {conv["conversation_id"]: conv for conv in conversations}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.audio_size = audio_size
+        self.turns = turns
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _should_fail(self):
+        with self.lock:
+            return self.error_rate and self.random.random() < self.error_rate
+
+    def _count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def list_page(self, query):
+        start_after = int(query.get("call_start_after_unix", ["0"])[0])
+        end_before = int(query.get("call_start_before_unix", ["0"])[0]) or None
+        agent_id = query.get("agent_id", [None])[0]
+        page_size = int(query.get("page_size", ["30"])[0])
+        cursor = int(query.get("cursor", ["0"])[0] or 0)
+        items = [
+            conv for conv in self.conversations
+            if conv["start_time_unix_secs"] >= start_after
+            and (end_before is None or conv["start_time_unix_secs"] < end_before)
+            and (agent_id is None or conv["agent_id"] == agent_id)
+        ]
+        # Как в ответе ElevenLabs: в списке есть число реплик и summary, но не сам транскрипт
+        page = [
+            dict(conv, message_count=self.turns, transcript_summary=f"Клиент спрашивал про заказ {conv['conversation_id']}.")
+            for conv in items[cursor:cursor + page_size]
+        ]
+        has_more = cursor + page_size < len(items)
+        return {"conversations": page, "has_more": has_more, "next_cursor": str(cursor + page_size) if has_more else None}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                parts = url.path.rstrip('/').split('/')
+                if parts[-1] == 'conversations':
+                    endpoint = 'list'
+                elif parts[-1] == 'audio':
+                    endpoint = 'audio'
+                else:
+                    endpoint = 'details'
+                fake._count(endpoint)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake._should_fail():
+                    self.send_response(503)
+                    self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                if endpoint == 'list':
+                    return self._send(200, json.dumps(fake.list_page(parse_qs(url.query))).encode())
+                conv = fake.by_id.get(parts[-2] if endpoint == 'audio' else parts[-1])
+                if conv is None:
+                    return self._send(404, b'{"detail": "not found"}')
+                if endpoint == 'details':
+                    return self._send(200, json.dumps(make_details(conv, fake.turns)).encode())
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/mpeg')
+                self.send_header('Content-Length', str(fake.audio_size))
+                self.end_headers()
+                # Содержимое своё у каждого разговора — как у настоящих записей (кэш аудио адресует по sha256)
+                chunk = (conv["conversation_id"].encode() * (65536 // len(conv["conversation_id"]) + 1))[:65536]
+                remaining = fake.audio_size
+                while remaining > 0:
+                    self.wfile.write(chunk[:remaining])
+                    remaining -= len(chunk)
+
+        return Handler
+
+
+class _Request:
+    def __init__(self, google, name, func):
+        self.google = google
+        self.name = name
+        self.func = func
+
+    def execute(self, num_retries=0):
+        self.google.count(self.name)
+        if self.google.latency:
+            time.sleep(self.google.latency)
+        if self.google.should_fail():
+            raise HttpError(httplib2.Response({'status': 503, 'retry-after': '0'}), b'{}')
+        return self.func()
+
+
+class FakeGoogle:
+    """
+    Заменитель Docs и Drive клиентов googleapiclient. Документы хранятся строками
+    (insertText применяется так же, как в Google Docs), загрузки только вычитываются и считаются.
+    Один объект можно раздавать всем потокам: состояние защищено блокировкой.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.docs = {}
+        self.drive_files = {}
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def should_fail(self):
+        with self.lock:
+            return self.error_rate and self.random.random() < self.error_rate
+
+    # --- docs ---
+    def documents(self):
+        return self
+
+    def batchUpdate(self, documentId, body):
+        def apply():
+            with self.lock:
+                text = self.docs.get(documentId, '\n')
+                for request in body['requests']:
+                    insert = request.get('insertText')
+                    if insert is None:
+                        # Оформление текст не меняет: проверяем только, что диапазон внутри документа
+                        (kind, update), = request.items()
+                        if not 1 <= update['range']['startIndex'] < update['range']['endIndex'] <= len(text):
+                            raise ValueError(f"{kind}: диапазон вне документа {documentId}")
+                        self.calls[f'docs.{kind}'] += 1
+                        continue
+                    index = insert['location']['index']
+                    text = text[:index] + insert['text'] + text[index:]
+                self.docs[documentId] = text
+            return {'documentId': documentId, 'replies': [{} for _ in body['requests']]}
+        return _Request(self, 'docs.batchUpdate', apply)
+
+    def get(self, documentId, fields=None):
+        def apply():
+            with self.lock:
+                text = self.docs.get(documentId, '\n')
+            return {'documentId': documentId, 'body': {'content': [{'endIndex': len(text) + 1}]}}
+        return _Request(self, 'docs.get', apply)
+
+    # --- drive ---
+    def files(self):
+        return self
+
+    def create(self, body, media_body=None, fields=None):
+        def apply():
+            size = 0
+            if media_body is not None:
+                size = media_body.size()
+                media_body.getbytes(0, size)
+            with self.lock:
+                # ID зависит только от имени, чтобы ссылки (и итоговый Doc) не зависели от порядка загрузок
+                file_id = f"file_{body['name']}"
+                duplicates = sum(1 for existing in self.drive_files if existing.startswith(file_id))
+                if duplicates:
+                    file_id = f"{file_id}_{duplicates + 1}"
+                self.drive_files[file_id] = dict(body, size=size)
+                self.uploaded_bytes += size
+            return {'id': file_id, 'webViewLink': f"https://drive.google.com/file/d/{file_id}/view"}
+        return _Request(self, 'drive.files.create', apply)
+
+    def list(self, q, fields=None, pageSize=100):
+        # Понимает только запрос вида "(name = '...' or ...) and '<folder>' in parents ...", как в sync_engine
+        names = re.findall(r"name = '([^']*)'", q)
+        folder = re.search(r"'([^']*)' in parents", q).group(1)
+
+        def apply():
+            with self.lock:
+                found = [
+                    {'id': file_id, 'webViewLink': f"https://drive.google.com/file/d/{file_id}/view"}
+                    for file_id, meta in self.drive_files.items()
+                    if meta['name'] in names and folder in meta.get('parents', [])
+                ]
+            return {'files': found[:pageSize]}
+        return _Request(self, 'drive.files.list', apply)
@@ -0,0 +1,104 @@
+"""
+Бенчмарк форматирования записей Google Doc на длинных транскриптах: обычный текст (SYNC_DOC_STYLE=plain)
+против оформленного (styled) — во сколько обходится оформление.
+
+    python -m bench.format_bench --turns 10000 --conversations 50
+
+Перед замерами проверяется, что в режиме styled текст тот же байт в байт,
+а диапазоны оформления указывают на подписи спикеров и заголовки.
+"""
+import argparse
+import random
+import time
+
+from doc_format import format_doc_entry, format_transcript, insert_requests
+
+ROLES = ['agent', 'user']
+WORDS = "заказ возврат доставка оплата карта адрес курьер номер спасибо подождите уточню order refund".split()
+
+
+def make_transcripts(conversations, turns, seed=0):
+    rng = random.Random(seed)
+    transcripts = []
+    for _ in range(conversations):
+        transcript = []
+        for i in range(turns):
+            # Иногда подряд говорит один спикер, иногда реплика пустая — как в реальных транскриптах
+            role = ROLES[i % 2] if rng.random() < 0.8 else ROLES[(i + 1) % 2]
+            message = "" if rng.random() < 0.03 else f"  {' '.join(rng.choices(WORDS, k=rng.randint(3, 25)))}. "
+            transcript.append({"role": role, "message": message, "time_in_call_secs": i})
+        transcripts.append(transcript)
+    return transcripts
+
+
+def entry_fields(i, transcript_text):
+    return {
+        "summary": f"Клиент {i} спрашивал про заказ." if i % 4 else "",
+        "transcript": transcript_text or "Транскрибация пуста.",
+        "audio_link": f"https://drive.google.com/file/d/file_{i}/view",
+        "start_time_str": f"2024-03-{i % 28 + 1:02d} 12:00:00",
+    }
+
+
+def format_entries(transcripts, styled=False):
+    formatted = []
+    for i, transcript in enumerate(transcripts):
+        if styled:
+            text, labels = format_transcript(transcript, with_labels=True)
+        else:
+            text, labels = format_transcript(transcript), None
+        entry = entry_fields(i, text)
+        entry["labels"] = labels if text else None
+        formatted.append(format_doc_entry(entry, styled=styled))
+    return formatted
+
+
+def check(transcripts):
+    expected = [content for content, _ in format_entries(transcripts)]
+    formatted = format_entries(transcripts, styled=True)
+    assert [content for content, _ in formatted] == expected, "текст в режиме styled отличается"
+    for content, ranges in formatted:
+        for start, end, kind in ranges:
+            fragment = content[start:end]
+            if kind == 'heading':
+                assert fragment.startswith('--- Запись от ') and fragment.endswith(' ---'), fragment
+            else:
+                assert fragment.endswith(':') and '\n' not in fragment, fragment
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=10000, help="реплик в каждом транскрипте")
+    parser.add_argument('--repeat', type=int, default=5, help="повторов, берётся лучший")
+    args = parser.parse_args(argv)
+
+    transcripts = make_transcripts(args.conversations, args.turns)
+    check(transcripts)
+    total_turns = args.conversations * args.turns
+
+    cases = [
+        ("plain", lambda: format_entries(transcripts)),
+        ("styled", lambda: format_entries(transcripts, styled=True)),
+        ("styled + запросы", lambda: [insert_requests(c, r) for c, r in format_entries(transcripts, styled=True)]),
+    ]
+    print(f"{args.conversations} разговоров по {args.turns} реплик; текст styled совпадает с plain байт в байт.")
+    print(f"{'вариант':<20}{'сек':>9}{'реплик/с':>14}")
+    baseline = None
+    for name, func in cases:
+        seconds = timed(func, args.repeat)
+        baseline = baseline or seconds
+        print(f"{name:<20}{seconds:>9.3f}{total_turns / seconds:>14,.0f}  x{baseline / seconds:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Бенчмарк памяти списка разговоров: весь список сразу (get_new_conversations + сортировка, как в main)
+против потокового iter_conversation_windows на больших историях.
+
+    python -m bench.listing_bench --sizes 10000,50000,100000
+
+Заглушка ElevenLabs работает в отдельном процессе, поэтому в замер попадает только сторона клиента.
+Память — пик tracemalloc за проход по списку; «до первого» — через сколько секунд можно начинать обработку.
+Проверяется, что потоковый список отдаёт те же разговоры в том же порядке, что и сортировка всего списка,
+и что его пик памяти не растёт с историей: на самой большой истории не больше --max-growth от самой маленькой.
+"""
+import argparse
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import time
+import tracemalloc
+
+AGENT_IDS = ["agent_bench_1", "agent_bench_2", "agent_bench_3"]
+
+
+def _serve(count, connection):
+    from bench.fakes import FakeElevenLabsServer, make_conversations
+
+    server = FakeElevenLabsServer(make_conversations(count, AGENT_IDS)).start()
+    connection.send(server.base_url)
+    connection.recv()
+    connection.send(dict(server.calls))
+    server.stop()
+
+
+class Digest:
+    """Порядок разговоров по агентам без хранения самих разговоров."""
+
+    def __init__(self):
+        self.hashes = {agent_id: hashlib.sha256() for agent_id in AGENT_IDS}
+        self.count = 0
+
+    def update(self, conversations_by_agent):
+        for agent_id, conversations in conversations_by_agent.items():
+            for conv in conversations:
+                self.hashes[agent_id].update(conv["conversation_id"].encode())
+            self.count += len(conversations)
+
+    def hexdigest(self):
+        return hashlib.sha256(b"".join(h.digest() for h in self.hashes.values())).hexdigest()[:16]
+
+
+def full_listing(client, digest):
+    conversations_by_agent = client.get_new_conversations(AGENT_IDS)
+    first = time.perf_counter()
+    for conversations in conversations_by_agent.values():
+        conversations.sort(key=lambda c: c.get("start_time_unix_secs", 0))
+    digest.update(conversations_by_agent)
+    return first
+
+
+def streaming_listing(client, digest):
+    first = None
+    for window in client.iter_conversation_windows(AGENT_IDS):
+        first = first or time.perf_counter()
+        digest.update(window)
+    return first
+
+
+def measure(base_url, func):
+    from elevenlabs_client import ElevenLabsClient
+
+    client = ElevenLabsClient("bench", base_url=base_url)
+    digest = Digest()
+    tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        first = func(client, digest)
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    client.close()
+    return {
+        "conversations": digest.count, "digest": digest.hexdigest(), "peak_mb": peak / 1024 / 1024,
+        "first_s": (first or time.perf_counter()) - started, "wall_s": wall,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,50000,100000', help="размеры истории через запятую")
+    parser.add_argument('--max-growth', type=float, default=1.5,
+                        help="во сколько раз пик потокового списка может вырасти от меньшей истории к большей")
+    args = parser.parse_args(argv)
+    os.environ.setdefault('SYNC_RATE_ELEVENLABS', '0')
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'история':>9}  {'вариант':<10}{'пик MB':>9}{'до первого, с':>15}{'всего, с':>10}{'запросов':>10}  порядок")
+    streaming_peaks = {}
+    for size in sorted(int(size) for size in args.sizes.split(',')):
+        results = {}
+        for name, func in (("весь", full_listing), ("окнами", streaming_listing)):
+            parent, child = context.Pipe()
+            server = context.Process(target=_serve, args=(size, child))
+            server.start()
+            base_url = parent.recv()
+            results[name] = measure(base_url, func)
+            parent.send(None)
+            results[name]["requests"] = parent.recv().get("list", 0)
+            server.join()
+        assert results["весь"]["conversations"] == results["окнами"]["conversations"] == size
+        assert results["весь"]["digest"] == results["окнами"]["digest"], "порядок разговоров отличается"
+        for name, r in results.items():
+            print(f"{size:>9}  {name:<10}{r['peak_mb']:>9.1f}{r['first_s']:>15.2f}{r['wall_s']:>10.1f}"
+                  f"{r['requests']:>10}  {r['digest']}")
+        streaming_peaks[size] = results["окнами"]["peak_mb"]
+
+    smallest, largest = min(streaming_peaks), max(streaming_peaks)
+    growth = streaming_peaks[largest] / streaming_peaks[smallest]
+    assert growth <= args.max_growth, (
+        f"пик потокового списка вырос в {growth:.2f} раза от {smallest} к {largest} разговорам"
+    )
+    print(f"Пик потокового списка: x{growth:.2f} от {smallest} к {largest} разговорам (допустимо x{args.max_growth}).")
+
+
+if __name__ == '__main__':
+    main()
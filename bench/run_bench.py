@@ -0,0 +1,316 @@
+"""
+Офлайн-бенчмарк синхронизации: ElevenLabs и Google заменены локальными заглушками из bench/fakes.py.
+
+    python -m bench.run_bench --conversations 500 --el-latency 0.05 --google-latency 0.1
+    python -m bench.run_bench --modes sequential,async --json bench_output.json
+
+Каждый режим запускается в отдельном процессе, чтобы пиковый RSS не смешивался между режимами.
+Отчёт: разговоров в секунду, p50/p99 по этапам, пиковый RSS и число вызовов каждого API.
+"""
+import argparse
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from bench.fakes import FakeElevenLabsServer, FakeGoogle, make_conversations
+
+STAGES = ['list', 'details', 'audio', 'upload', 'doc']
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, owner, name, stage):
+        """Подменяет owner.name обёрткой, которая замеряет время вызова (обычного или async)."""
+        func = getattr(owner, name)
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+        setattr(owner, name, timed)
+
+    def summary(self):
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "total_s": round(sum(values), 3),
+            }
+            for stage, values in sorted(self.samples.items())
+        }
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def _instrument_sync(timer):
+    import elevenlabs_client
+    import sync_engine
+
+    client_cls = elevenlabs_client.ElevenLabsClient
+    timer.wrap(client_cls, 'get_new_conversations', 'list')
+    timer.wrap(client_cls, '_list_window', 'list')
+    timer.wrap(client_cls, 'get_conversation_details', 'details')
+    timer.wrap(client_cls, 'download_conversation_audio', 'audio')
+    timer.wrap(client_cls, 'download_conversation_audio_stream', 'audio')
+    timer.wrap(sync_engine, 'upload_to_drive', 'upload')
+    timer.wrap(sync_engine, 'upload_stream_to_drive', 'upload')
+    timer.wrap(sync_engine, 'append_to_google_doc', 'doc')
+    timer.wrap(sync_engine, 'write_doc_batches', 'doc')
+
+
+def _instrument_async(timer):
+    import async_engine
+    import sync_engine
+
+    client_cls = async_engine.AsyncElevenLabsClient
+    timer.wrap(client_cls, 'get_new_conversations', 'list')
+    timer.wrap(client_cls, 'get_conversation_details', 'details')
+    timer.wrap(client_cls, 'download_conversation_audio_stream', 'audio')
+    timer.wrap(sync_engine, 'upload_stream_to_drive', 'upload')
+    timer.wrap(sync_engine, 'append_to_google_doc', 'doc')
+    timer.wrap(sync_engine, 'write_doc_batches', 'doc')
+
+
+def _use_fake_google(google):
+    import sync_engine
+    modules = [sync_engine]
+    for name in ('async_engine', 'pipeline', 'supervisor'):
+        if name in sys.modules:
+            modules.append(sys.modules[name])
+    for module in modules:
+        module.get_google_services = lambda: (google, google)
+        module.get_thread_drive_service = lambda: google
+
+
+def _run_sequential(agents, args):
+    import sync_engine
+    sync_engine.main(agents, workers=1)
+
+
+def _run_threaded(agents, args):
+    import sync_engine
+    sync_engine.main(agents, workers=args.workers)
+
+
+def _run_threaded_batch(agents, args):
+    import sync_engine
+    sync_engine.DOC_BATCH_MODE = True
+    sync_engine.main(agents, workers=args.workers)
+
+
+def _run_streaming(agents, args):
+    import sync_engine
+    sync_engine.LISTING_STREAM = True
+    sync_engine.main(agents, workers=args.workers)
+
+
+def _run_async(agents, args):
+    import async_engine
+    async_engine.main(agents)
+
+
+def _run_pipeline(agents, args):
+    import pipeline
+    pipeline.main(agents)
+
+
+def _run_supervisor(agents, args):
+    import supervisor
+    supervisor.LISTING_STREAM = True
+    supervisor.main(agents, workers=args.workers)
+
+
+def _run_supervisor_list(agents, args):
+    import supervisor
+    supervisor.LISTING_STREAM = False
+    supervisor.main(agents, workers=args.workers)
+
+
+def _run_queue(agents, args):
+    import sync_engine
+    import work_queue
+    queue = work_queue.WorkQueue()
+    work_queue.discover(queue, agents)
+    docs_service, _ = sync_engine.get_google_services()
+    work_queue.QueueWorker(queue, agents, docs_service, workers=args.workers, poll_interval=0.02).run(drain=True)
+    queue.close()
+
+
+# Режим -> (функция запуска, функция подмены замеров). Новые режимы выполнения добавляются сюда.
+MODES = {
+    'sequential': (_run_sequential, _instrument_sync),
+    'threaded': (_run_threaded, _instrument_sync),
+    'threaded-batch': (_run_threaded_batch, _instrument_sync),
+    'streaming': (_run_streaming, _instrument_sync),
+    'async': (_run_async, _instrument_async),
+    'pipeline': (_run_pipeline, _instrument_sync),
+    'queue': (_run_queue, _instrument_sync),
+    'supervisor': (_run_supervisor, _instrument_sync),
+    'supervisor-list': (_run_supervisor_list, _instrument_sync),
+}
+
+
+def run_child(mode, args):
+    agent_ids = [f"agent_bench_{i + 1}" for i in range(args.agents)]
+    conversations = make_conversations(args.conversations, agent_ids)
+    server = FakeElevenLabsServer(
+        conversations, latency=args.el_latency, error_rate=args.el_error_rate,
+        audio_size=args.audio_size, turns=args.turns,
+    ).start()
+    google = FakeGoogle(latency=args.google_latency, error_rate=args.google_error_rate)
+
+    # Конфигурация движка читается при импорте, поэтому окружение задаётся до него
+    os.environ['ELEVENLABS_API_BASE_URL'] = server.base_url
+    os.environ.setdefault('ELEVENLABS_API_KEY', 'bench')
+    os.environ.setdefault('SYNC_RETRY_BASE_DELAY', '0.01')
+    if not args.rate_limits:
+        for upstream in ('ELEVENLABS', 'DOCS', 'DRIVE'):
+            os.environ[f'SYNC_RATE_{upstream}'] = '0'
+    os.environ['SYNC_WORKERS'] = str(args.workers)
+    if args.drive_lookup:
+        os.environ['SYNC_DRIVE_LOOKUP'] = '1'
+
+    run, instrument = MODES[mode]
+    import state_store
+    import sync_engine
+    if mode == 'async':
+        import async_engine  # noqa: F401
+    if mode == 'pipeline':
+        import pipeline  # noqa: F401
+    if mode.startswith('supervisor'):
+        import supervisor  # noqa: F401
+    timer = StageTimer()
+    instrument(timer)
+    _use_fake_google(google)
+
+    workdir = tempfile.mkdtemp(prefix=f"bench_{mode}_")
+    os.chdir(workdir)
+    agents = [
+        sync_engine.AgentConfig(agent_id, f"doc_{i + 1}", f"folder_{i + 1}", f"agent_{i + 1}_processed_ids.txt", name=f"agent_{i + 1}")
+        for i, agent_id in enumerate(agent_ids)
+    ]
+
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        run(agents, args)
+    wall = time.perf_counter() - started
+    server.stop()
+
+    processed = 0
+    for agent in agents:
+        store = state_store.open_state_store(agent)
+        processed += store.count()
+        store.close()
+    docs_digest = hashlib.sha256(json.dumps(google.docs, sort_keys=True).encode()).hexdigest()[:16]
+    return {
+        "mode": mode,
+        "conversations": processed,
+        "wall_s": round(wall, 3),
+        "conv_per_sec": round(processed / wall, 2) if wall else 0.0,
+        "stages": timer.summary(),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "api_calls": dict(sorted({**{f"elevenlabs.{k}": v for k, v in server.calls.items()}, **google.calls}.items())),
+        "uploaded_mb": round(google.uploaded_bytes / 1024 / 1024, 2),
+        "docs_digest": docs_digest,
+    }
+
+
+def print_table(results):
+    print(f"{'mode':<16}{'conv':>6}{'wall s':>9}{'conv/s':>9}{'RSS MB':>9}  digest")
+    for r in results:
+        print(f"{r['mode']:<16}{r['conversations']:>6}{r['wall_s']:>9}{r['conv_per_sec']:>9}{r['peak_rss_mb']:>9}  {r['docs_digest']}")
+    print()
+    print(f"{'mode':<16}{'stage':<9}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        for stage in STAGES:
+            s = r['stages'].get(stage)
+            if s:
+                print(f"{r['mode']:<16}{stage:<9}{s['count']:>7}{s['p50_ms']:>10}{s['p99_ms']:>10}")
+    print()
+    for r in results:
+        calls = ', '.join(f"{k}={v}" for k, v in r['api_calls'].items())
+        print(f"{r['mode']:<16}{calls}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default=','.join(MODES), help="режимы через запятую")
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--agents', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--audio-size', type=int, default=256 * 1024, help="байт аудио на разговор")
+    parser.add_argument('--turns', type=int, default=6, help="реплик в транскрипте")
+    parser.add_argument('--el-latency', type=float, default=0.02, help="задержка ответа ElevenLabs, с")
+    parser.add_argument('--el-error-rate', type=float, default=0.0, help="доля ответов 503 от ElevenLabs")
+    parser.add_argument('--google-latency', type=float, default=0.05, help="задержка вызова Docs/Drive, с")
+    parser.add_argument('--google-error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limits', action='store_true', help="не отключать token bucket лимиты")
+    parser.add_argument('--drive-lookup', action='store_true', help="искать аудио на Drive перед скачиванием")
+    parser.add_argument('--json', help="куда сохранить результаты в JSON")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(run_child(args.child, args)))
+        return
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for mode in args.modes.split(','):
+        if mode not in MODES:
+            sys.exit(f"Неизвестный режим: {mode}. Доступны: {', '.join(MODES)}")
+        child = subprocess.run(
+            [sys.executable, '-m', 'bench.run_bench', '--child', mode, *argv],
+            cwd=repo_root, capture_output=True, text=True,
+        )
+        if child.returncode != 0:
+            sys.exit(f"Режим {mode} завершился с ошибкой:\n{child.stderr}")
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Постоянно работающий режим синхронизации вместо запуска по cron.
+
+    python daemon.py
+
+Клиенты ElevenLabs и Google создаются один раз и живут весь процесс. Список разговоров опрашивается
+с интервалом от SYNC_DAEMON_MIN_INTERVAL до SYNC_DAEMON_MAX_INTERVAL секунд: после опроса без новых
+разговоров интервал растёт в SYNC_DAEMON_BACKOFF раз, после найденных — сбрасывается к минимуму.
+
+Локальный HTTP-эндпоинт (SYNC_WEBHOOK_HOST:SYNC_WEBHOOK_PORT) принимает post-call вебхуки ElevenLabs
+(или просто {"agent_id": ..., "conversation_id": ...}) и сразу синхронизирует указанный разговор.
+Если задан SYNC_WEBHOOK_SECRET, проверяется подпись из заголовка ElevenLabs-Signature.
+GET /healthz отдаёт состояние демона.
+"""
+import hashlib
+import hmac
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from elevenlabs_client import ListingError
+import run_report
+from sync_engine import (
+    close_details_source, configured_agents, get_google_services, list_agent_conversations, load_agents_from_env, process_agent,
+    process_conversation_ids,
+)
+
+DAEMON_MIN_INTERVAL = float(os.getenv('SYNC_DAEMON_MIN_INTERVAL', '15'))
+DAEMON_MAX_INTERVAL = float(os.getenv('SYNC_DAEMON_MAX_INTERVAL', '300'))
+DAEMON_BACKOFF = float(os.getenv('SYNC_DAEMON_BACKOFF', '2'))
+
+WEBHOOK_HOST = os.getenv('SYNC_WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('SYNC_WEBHOOK_PORT', '8787'))  # 0 — эндпоинт выключен
+WEBHOOK_SECRET = os.getenv('SYNC_WEBHOOK_SECRET')
+# Насколько старой может быть подпись вебхука (защита от повторной отправки)
+WEBHOOK_TOLERANCE_SECS = 30 * 60
+
+_STOP = object()
+
+
+def parse_webhook(body):
+    """(agent_id, conversation_id) из тела вебхука или None, если это не уведомление о разговоре."""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    # Post-call вебхук ElevenLabs кладёт разговор в "data"; простой формат — поля на верхнем уровне
+    data = payload.get("data") if isinstance(payload.get("data"), dict) else payload
+    agent_id, conversation_id = data.get("agent_id"), data.get("conversation_id")
+    if not agent_id or not conversation_id:
+        return None
+    return agent_id, conversation_id
+
+
+def verify_signature(header, body, secret, now=None):
+    """Заголовок ElevenLabs-Signature: "t=<unix>,v0=<hex HMAC-SHA256 от "<t>.<body>">"."""
+    if not header:
+        return False
+    parts = dict(item.split('=', 1) for item in header.split(',') if '=' in item)
+    timestamp, signature = parts.get('t'), parts.get('v0')
+    if not timestamp or not signature or not timestamp.isdigit():
+        return False
+    now = time.time() if now is None else now
+    if abs(now - int(timestamp)) > WEBHOOK_TOLERANCE_SECS:
+        return False
+    expected = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+class SyncDaemon:
+    def __init__(self, agents, docs_service, workers=None,
+                 min_interval=DAEMON_MIN_INTERVAL, max_interval=DAEMON_MAX_INTERVAL, backoff=DAEMON_BACKOFF):
+        self.agents = agents
+        self.agents_by_id = {agent.agent_id: agent for agent in agents}
+        self.docs_service = docs_service
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.events = queue.Queue()
+        self.last_poll = None
+        self.polls = 0
+        self.webhooks = 0
+        self.errors = 0
+
+    def notify(self, agent_id, conversation_id):
+        """Ставит разговор в очередь на немедленную синхронизацию. False — агент не обслуживается."""
+        if agent_id not in self.agents_by_id:
+            return False
+        self.events.put((agent_id, conversation_id))
+        return True
+
+    def stop(self):
+        self.events.put(_STOP)
+
+    def poll(self):
+        """Один проход, как у sync_engine.main. Возвращает число найденных новых разговоров."""
+        try:
+            conversations_by_agent = list_agent_conversations(self.agents)
+        except ListingError as e:
+            print(f"Не удалось получить список разговоров: {e}")
+            return 0
+        found = 0
+        for agent in self.agents:
+            try:
+                found += process_agent(
+                    agent, conversations_by_agent.get(agent.agent_id, []), self.docs_service, None, self.workers,
+                ) or 0
+            except Exception:
+                # Ошибка одного агента не мешает остальным; его разговоры будут повторены в следующем опросе
+                self._log_error(f"[{agent.name}] Ошибка обработки агента")
+        self.last_poll = time.time()
+        self.polls += 1
+        return found
+
+    def sync_conversation(self, agent_id, conversation_id):
+        agent = self.agents_by_id[agent_id]
+        print(f"[{agent.name}] Вебхук: синхронизация разговора {conversation_id}.")
+        new_ids, _ = process_conversation_ids(agent, [conversation_id], self.docs_service, self.workers)
+        self.webhooks += 1
+        return len(new_ids)
+
+    def _log_error(self, message):
+        self.errors += 1
+        print(f"{message}:")
+        traceback.print_exc()
+
+    def _finish_cycle(self, handled):
+        # Отчёт пишется только за циклы с работой, чтобы холостые опросы не засоряли лог
+        # Предзагрузка не переходит в следующий цикл: разговоры, отложенные по бюджету, придут с новым списком
+        close_details_source()
+        if handled:
+            run_report.finish_run()
+        run_report.reset()
+
+    def run(self):
+        next_poll = 0.0
+        while True:
+            # Демон работает бессрочно: любая ошибка цикла (блокировка SQLite, запись состояния, Docs после
+            # всех повторов) записывается в лог, а следующий опрос идёт по обычному расписанию с паузой.
+            # Опрос, которому пора, идёт раньше вебхуков в очереди: их поток не должен откладывать его
+            if time.monotonic() >= next_poll:
+                try:
+                    found = self.poll()
+                except Exception:
+                    self._log_error("Ошибка опроса списка разговоров")
+                    found = 0
+                self._finish_cycle(found)
+                if found:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * self.backoff, self.max_interval)
+                next_poll = time.monotonic() + self.interval
+
+            try:
+                event = self.events.get(timeout=max(next_poll - time.monotonic(), 0))
+            except queue.Empty:
+                continue
+            if event is _STOP:
+                return
+            try:
+                handled = self.sync_conversation(*event)
+            except Exception:
+                self._log_error(f"Ошибка синхронизации разговора {event[1]} из вебхука")
+                handled = 0
+            self._finish_cycle(handled)
+
+    def health(self):
+        return {
+            "last_poll": self.last_poll,
+            "interval_seconds": self.interval,
+            "polls": self.polls,
+            "webhooks": self.webhooks,
+            "errors": self.errors,
+            "queued": self.events.qsize(),
+        }
+
+
+def make_webhook_server(daemon, host=WEBHOOK_HOST, port=WEBHOOK_PORT, secret=WEBHOOK_SECRET):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/healthz':
+                return self._send(200, daemon.health())
+            self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if secret and not verify_signature(self.headers.get('ElevenLabs-Signature'), body, secret):
+                return self._send(401, {"error": "invalid signature"})
+            event = parse_webhook(body)
+            if event is None:
+                return self._send(400, {"error": "agent_id and conversation_id are required"})
+            if not daemon.notify(*event):
+                return self._send(404, {"error": f"unknown agent {event[0]}"})
+            self._send(202, {"queued": event[1]})
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(agents=None):
+    print("Начало работы демона синхронизации...")
+    agents = load_agents_from_env() if agents is None else configured_agents(agents)
+    if not agents:
+        sys.exit("Не настроено ни одного агента.")
+
+    docs_service, drive_service = get_google_services()
+    if not all([docs_service, drive_service]):
+        sys.exit("Не удалось подключиться к сервисам Google.")
+
+    daemon = SyncDaemon(agents, docs_service)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: daemon.stop())
+
+    server = None
+    if WEBHOOK_PORT:
+        server = make_webhook_server(daemon)
+        threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+        print(f"Вебхуки принимаются на http://{WEBHOOK_HOST}:{server.server_address[1]}/")
+
+    try:
+        daemon.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    print("Демон синхронизации остановлен.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+import contextvars
+import gzip
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Слой над GET /convai/conversations/{id}.
+#  - Данные из списка разговоров: если их достаточно для записи (в разговоре нет реплик, а summary
+#    есть в списке), детали не запрашиваются; поля, которых нет в деталях, дополняются из списка.
+#  - Предзагрузка: пока обрабатывается разговор, детали следующих SYNC_DETAILS_PREFETCH уже качаются.
+#  - Дисковый кэш (SYNC_DETAILS_CACHE_DIR, пусто — выключен): повторная попытка разговора, у которого
+#    не удалась загрузка аудио или запись в Doc, не запрашивает детали снова. Записи живут
+#    SYNC_DETAILS_CACHE_TTL секунд, сверх SYNC_DETAILS_CACHE_MAX_ENTRIES вытесняются давно не читанные.
+DETAILS_CACHE_DIR = os.getenv('SYNC_DETAILS_CACHE_DIR', 'details_cache')
+DETAILS_CACHE_TTL = int(os.getenv('SYNC_DETAILS_CACHE_TTL', str(7 * 24 * 3600)))
+DETAILS_CACHE_MAX_ENTRIES = int(os.getenv('SYNC_DETAILS_CACHE_MAX_ENTRIES', '2000'))
+DETAILS_PREFETCH = int(os.getenv('SYNC_DETAILS_PREFETCH', '4'))
+
+# Детали разговора, который ещё идёт или обрабатывается, могут измениться — такие не кэшируются
+UNFINISHED_STATUSES = ('initiated', 'in-progress', 'processing')
+
+
+class DetailsCache:
+    """Файл <conversation_id>.json.gz на разговор; время последнего чтения — mtime файла (для LRU)."""
+
+    def __init__(self, root, ttl=DETAILS_CACHE_TTL, max_entries=DETAILS_CACHE_MAX_ENTRIES):
+        self.root = root
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.count = sum(1 for name in os.listdir(root) if name.endswith('.json.gz'))
+
+    def _path(self, conversation_id):
+        return os.path.join(self.root, f"{conversation_id}.json.gz")
+
+    def get(self, conversation_id):
+        path = self._path(conversation_id)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Повреждённая запись кэша деталей {path}: {e}")
+            self.discard(conversation_id)
+            return None
+        if time.time() - record.get("cached_at", 0) > self.ttl:
+            self.discard(conversation_id)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return record.get("details")
+
+    def put(self, conversation_id, details):
+        if details.get("status") in UNFINISHED_STATUSES:
+            return
+        path = self._path(conversation_id)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({"cached_at": int(time.time()), "details": details}, f, ensure_ascii=False)
+        existed = os.path.exists(path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if not existed:
+                self.count += 1
+            if self.count > self.max_entries:
+                self._evict()
+
+    def discard(self, conversation_id):
+        try:
+            os.remove(self._path(conversation_id))
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.count -= 1
+
+    def _evict(self):
+        """Удаляет давно не читанные записи до 90% лимита, чтобы не сканировать каталог на каждой записи."""
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.json.gz'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+        entries.sort()
+        excess = len(entries) - int(self.max_entries * 0.9)
+        for _, path in entries[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.count = len(entries) - max(excess, 0)
+
+
+class NullDetailsCache:
+    """Кэш деталей выключен (SYNC_DETAILS_CACHE_DIR пуст)."""
+
+    def get(self, conversation_id):
+        return None
+
+    def put(self, conversation_id, details):
+        pass
+
+    def discard(self, conversation_id):
+        pass
+
+
+def open_details_cache(root=None):
+    root = DETAILS_CACHE_DIR if root is None else root
+    return DetailsCache(root) if root else NullDetailsCache()
+
+
+def details_from_listing(summary):
+    """Детали из элемента списка, если их хватает для записи: разговор без реплик с summary в списке."""
+    if summary.get("message_count") != 0 or "transcript_summary" not in summary:
+        return None
+    return {
+        "conversation_id": summary.get("conversation_id"),
+        "agent_id": summary.get("agent_id"),
+        "status": summary.get("status"),
+        "metadata": {
+            "start_time_unix_secs": summary.get("start_time_unix_secs"),
+            "call_duration_secs": summary.get("call_duration_secs"),
+        },
+        "analysis": {"transcript_summary": summary.get("transcript_summary") or ""},
+        "transcript": [],
+    }
+
+
+def merge_listing(details, summary):
+    """Поля, которые есть в списке, но отсутствуют в деталях."""
+    details.setdefault("agent_id", summary.get("agent_id"))
+    details.setdefault("status", summary.get("status"))
+    metadata = details.setdefault("metadata", {})
+    for field in ("start_time_unix_secs", "call_duration_secs"):
+        if metadata.get(field) is None and summary.get(field) is not None:
+            metadata[field] = summary[field]
+    return details
+
+
+class DetailsSource:
+    """
+    Детали разговоров для движков синхронизации. fetch — запрос деталей к API (conversation_id -> dict).
+    Один запрос на разговор даже при одновременных get() и предзагрузке из разных потоков.
+    """
+
+    def __init__(self, fetch, cache, prefetch=DETAILS_PREFETCH):
+        self.fetch = fetch
+        self.cache = cache
+        self.prefetch = prefetch
+        self.lock = threading.Lock()
+        self.listing = {}
+        self.order = {}
+        self.futures = {}
+        self.executor = None
+
+    def remember_listing(self, conversations):
+        """Элементы списка для разговоров, которые предстоит обработать."""
+        with self.lock:
+            for conv in conversations:
+                if conv.get('conversation_id'):
+                    self.listing[conv['conversation_id']] = conv
+
+    def schedule(self, conversation_ids):
+        """Порядок обработки: get() для разговора начинает загрузку деталей следующих за ним."""
+        if self.prefetch <= 0:
+            return
+        conversation_ids = list(conversation_ids)
+        with self.lock:
+            for i, conv_id in enumerate(conversation_ids):
+                self.order[conv_id] = (conversation_ids, i)
+
+    def cached(self, conversation_id):
+        """Детали без запроса к API (дисковый кэш или список) или None."""
+        with self.lock:
+            summary = self.listing.get(conversation_id)
+        details = self.cache.get(conversation_id)
+        if details is not None:
+            print(f"Детали {conversation_id} взяты из локального кэша.")
+            return merge_listing(details, summary) if summary else details
+        details = details_from_listing(summary) if summary else None
+        if details is not None:
+            print(f"Разговор {conversation_id} без реплик: детали взяты из списка разговоров.")
+        return details
+
+    def store(self, conversation_id, details):
+        """Сохраняет полученные из API детали в кэш; возвращает их, дополненные данными списка."""
+        if not details:
+            return details
+        try:
+            self.cache.put(conversation_id, details)
+        except OSError as e:
+            print(f"Не удалось сохранить детали {conversation_id} в кэш: {e}")
+        with self.lock:
+            summary = self.listing.get(conversation_id)
+        return merge_listing(details, summary) if summary else details
+
+    def _load(self, conversation_id):
+        details = self.cached(conversation_id)
+        if details is None:
+            details = self.store(conversation_id, self.fetch(conversation_id))
+        return details
+
+    def _start(self, conversation_id, executor=None):
+        """Future с деталями разговора; новый запрос, только если его ещё нет. Вызывается под self.lock."""
+        future = self.futures.get(conversation_id)
+        if future is not None:
+            return future, False
+        if executor is not None:
+            # В контексте вызывающего: запросы предзагрузки попадают в отчёт о запуске под его агентом
+            future = executor.submit(contextvars.copy_context().run, self._load, conversation_id)
+        else:
+            future = Future()
+        self.futures[conversation_id] = future
+        return future, executor is None
+
+    def _prefetch_after(self, conversation_id):
+        position = self.order.pop(conversation_id, None)
+        if position is None:
+            return
+        ids, i = position
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix='details-prefetch')
+        for next_id in ids[i + 1:i + 1 + self.prefetch]:
+            if next_id in self.order:
+                self._start(next_id, self.executor)
+
+    def get(self, conversation_id):
+        with self.lock:
+            self._prefetch_after(conversation_id)
+            future, owner = self._start(conversation_id)
+        if owner:
+            try:
+                future.set_result(self._load(conversation_id))
+            except BaseException as e:
+                future.set_exception(e)
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                self.futures.pop(conversation_id, None)
+                self.order.pop(conversation_id, None)
+                self.listing.pop(conversation_id, None)
+
+    def close(self):
+        """
+        Конец запуска: останавливает предзагрузку и забывает незабранные детали (например, разговоров,
+        отложенных по бюджету) и данные списка. Источником можно пользоваться дальше — пул создастся заново.
+        """
+        with self.lock:
+            executor, self.executor = self.executor, None
+            self.futures.clear()
+            self.order.clear()
+            self.listing.clear()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
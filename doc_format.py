@@ -0,0 +1,131 @@
+import os
+import re
+
+# Оформление записей в Google Doc (SYNC_DOC_STYLE):
+#   plain  — только текст, как раньше (режим совместимости);
+#   styled — тот же текст плюс запросы оформления: заголовок записи, жирные подписи разделов и спикеров.
+# Текст записи в обоих режимах одинаковый байт в байт.
+DOC_STYLE = os.getenv('SYNC_DOC_STYLE', 'plain')
+DOC_STYLES = ('plain', 'styled')
+if DOC_STYLE not in DOC_STYLES:
+    raise ValueError(f"Неизвестный режим оформления Google Doc: {DOC_STYLE}")
+
+ENTRY_HEADING_STYLE = 'HEADING_3'
+
+_SUMMARY_TITLE = "Краткое содержание (Summary):"
+_TRANSCRIPT_TITLE = "Транскрибация:"
+_AUDIO_TITLE = "Ссылка на аудиофайл:"
+_ENTRY_FOOTER = "-----------------------------------------\n\n"
+
+# Символы вне BMP занимают в индексах Google Docs две единицы UTF-16
+_ASTRAL = re.compile('[\U00010000-\U0010FFFF]')
+
+
+def format_transcript(transcript_data, with_labels=False):
+    """
+    Текст транскрипта: реплика на строку, пустая строка при смене спикера. При with_labels возвращает
+    (текст, подписи), где подписи — [(начало, конец), ...] позиций "Agent:" в тексте (для SYNC_DOC_STYLE=styled).
+    """
+    lines = []
+    labels = []
+    pos = 0
+    last_role = None
+    if not transcript_data:
+        return ("", []) if with_labels else ""
+
+    for msg in transcript_data:
+        current_role = msg.get("role", "UNKNOWN")
+
+        # Добавляем пустую строку, если спикер сменился
+        if last_role and last_role != current_role:
+            lines.append("")
+            pos += 1
+
+        text = (msg.get("message") or "").strip()
+        if text:
+            label = f"{current_role.capitalize()}:"
+            labels.append((pos, pos + len(label)))
+            line = f"{label} {text}"
+            lines.append(line)
+            pos += len(line) + 1
+
+        last_role = current_role
+
+    text = "\n".join(lines)
+    return (text, labels) if with_labels else text
+
+def format_doc_entry(entry, styled=False):
+    """
+    Текст записи Google Doc из полей conversation_entry. Возвращает (текст, оформление); оформление —
+    None или [(начало, конец, 'heading' | 'bold'), ...] в позициях текста, см. insert_requests.
+    Подписи спикеров берутся из entry["labels"] (conversation_entry при SYNC_DOC_STYLE=styled).
+    """
+    summary, transcript = entry["summary"], entry["transcript"]
+    header = f"--- Запись от {entry['start_time_str']} ---"
+    summary_block = f"{_SUMMARY_TITLE}\n{summary}\n\n" if summary else ""
+    content = (
+        f"{header}\n\n"
+        f"{summary_block}"
+        f"{_TRANSCRIPT_TITLE}\n{transcript}\n\n"
+        f"{_AUDIO_TITLE} {entry['audio_link']}\n\n"
+        f"{_ENTRY_FOOTER}"
+    )
+    if not styled:
+        return content, None
+
+    ranges = [(0, len(header), 'heading')]
+    if summary_block:
+        ranges.append((len(header) + 2, len(header) + 2 + len(_SUMMARY_TITLE), 'bold'))
+    transcript_at = len(header) + 2 + len(summary_block) + len(_TRANSCRIPT_TITLE) + 1
+    ranges.append((transcript_at - len(_TRANSCRIPT_TITLE) - 1, transcript_at - 1, 'bold'))
+    ranges.extend((transcript_at + start, transcript_at + end, 'bold') for start, end in entry.get("labels") or ())
+    audio_at = transcript_at + len(transcript) + 2
+    ranges.append((audio_at, audio_at + len(_AUDIO_TITLE), 'bold'))
+    return content, ranges
+
+
+def _utf16_index(content, positions):
+    """Позиции символов строки -> индексы Google Docs (единицы UTF-16)."""
+    astral = [match.start() for match in _ASTRAL.finditer(content)]
+    if not astral:
+        return positions
+    shifted = []
+    i = 0
+    for position in positions:
+        while i < len(astral) and astral[i] < position:
+            i += 1
+        shifted.append(position + i)
+    return shifted
+
+
+def insert_requests(content, ranges=None, index=1):
+    """
+    Запросы batchUpdate для вставки записи в позицию index. Оформление применяется сразу после вставки,
+    пока более новые записи не сдвинули текст. Вставленный текст наследует стиль абзаца, в который
+    попал (заголовок предыдущей записи), поэтому сначала он сбрасывается к обычному.
+    """
+    requests = [{'insertText': {'location': {'index': index}, 'text': content}}]
+    if not ranges:
+        return requests
+    bounds = sorted({0, len(content)}.union(p for start, end, _ in ranges for p in (start, end)))
+    to_doc = dict(zip(bounds, _utf16_index(content, bounds)))
+
+    def doc_range(start, end):
+        return {'startIndex': index + to_doc[start], 'endIndex': index + to_doc[end]}
+
+    whole = doc_range(0, len(content))
+    requests.append({'updateParagraphStyle': {
+        'range': whole, 'paragraphStyle': {'namedStyleType': 'NORMAL_TEXT'}, 'fields': 'namedStyleType',
+    }})
+    requests.append({'updateTextStyle': {'range': whole, 'textStyle': {'bold': False}, 'fields': 'bold'}})
+    for start, end, kind in ranges:
+        if kind == 'heading':
+            requests.append({'updateParagraphStyle': {
+                'range': doc_range(start, end), 'paragraphStyle': {'namedStyleType': ENTRY_HEADING_STYLE},
+                'fields': 'namedStyleType',
+            }})
+        else:
+            requests.append({'updateTextStyle': {
+                'range': doc_range(start, end), 'textStyle': {'bold': True}, 'fields': 'bold',
+            }})
+    return requests
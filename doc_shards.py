@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import threading
+import time
+
+from retry import RATE_LIMIT_STATUSES, execute_with_retry
+
+# Ротация Google Doc агента. Каждая запись вставляется в начало документа, и с ростом документа
+# правки в нём становятся медленнее, а сам он упирается в лимит размера Google Docs.
+# Политики (SYNC_DOC_ROLLOVER):
+#   none    — один документ AGENT_N_DOC_ID, как раньше;
+#   month   — отдельный документ на каждый месяц (по дате начала разговора);
+#   entries — новый документ после SYNC_DOC_ROLLOVER_ENTRIES записей;
+#   chars   — новый документ, когда оценка размера превысит SYNC_DOC_ROLLOVER_CHARS символов.
+# Новые документы создаются в папке агента на Drive, список частей хранится в agent_N_docs.json.
+ROLLOVER_POLICY = os.getenv('SYNC_DOC_ROLLOVER', 'none')
+ROLLOVER_ENTRIES = int(os.getenv('SYNC_DOC_ROLLOVER_ENTRIES', '1000'))
+ROLLOVER_CHARS = int(os.getenv('SYNC_DOC_ROLLOVER_CHARS', '900000'))
+
+ROLLOVER_POLICIES = ('none', 'month', 'entries', 'chars')
+
+DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+
+# Заголовок записи из doc_format.format_doc_entry: "--- Запись от YYYY-MM-DD HH:MM:SS ---"
+_ENTRY_MONTH = re.compile(r'--- Запись от (\d{4}-\d{2})')
+
+
+def doc_url(doc_id):
+    return f"https://docs.google.com/document/d/{doc_id}/edit"
+
+
+def entry_month(content):
+    match = _ENTRY_MONTH.match(content)
+    return match.group(1) if match else None
+
+
+class DocShards:
+    """
+    Выбирает документ для каждой записи и при необходимости создаёт следующий.
+    Счётчики записей и символов — оценка: место резервируется при выборе документа, ещё до записи.
+    """
+
+    def __init__(self, agent, get_drive_service, policy=None, max_entries=None, max_chars=None):
+        self.agent = agent
+        self.get_drive_service = get_drive_service
+        self.policy = policy or ROLLOVER_POLICY
+        if self.policy not in ROLLOVER_POLICIES:
+            raise ValueError(f"Неизвестная политика ротации Google Doc: {self.policy}")
+        self.max_entries = max_entries or ROLLOVER_ENTRIES
+        self.max_chars = max_chars or ROLLOVER_CHARS
+        self.path = agent.doc_index_file
+        self.lock = threading.Lock()
+        self.index = None
+
+    def _load(self, docs_service):
+        if self.index is not None:
+            return self.index
+        index = None
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+        if not index or index.get("base_doc_id") != self.agent.doc_id:
+            # Первый запуск с ротацией: текущим документом становится AGENT_N_DOC_ID
+            index = {"base_doc_id": self.agent.doc_id, "shards": [{
+                "doc_id": self.agent.doc_id,
+                "key": None,
+                "entries": 0,
+                "chars": self._current_size(docs_service, self.agent.doc_id) if self.policy == 'chars' else 0,
+                "created_at": int(time.time()),
+            }]}
+        self.index = index
+        return index
+
+    def _current_size(self, docs_service, doc_id):
+        """Размер уже существующего документа (endIndex последнего элемента) — один запрос при первом запуске."""
+        try:
+            document = execute_with_retry('docs', lambda: docs_service.documents().get(
+                documentId=doc_id, fields='body(content(endIndex))'))
+            content = document.get('body', {}).get('content', [])
+            return content[-1].get('endIndex', 0) if content else 0
+        except Exception as e:
+            print(f"Не удалось узнать размер Google Doc {doc_id}: {e}")
+            return 0
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _needs_rollover(self, shard, content):
+        if self.policy == 'entries':
+            return shard["entries"] >= self.max_entries
+        if self.policy == 'chars':
+            return shard["entries"] > 0 and shard["chars"] + len(content) > self.max_chars
+        return False
+
+    def _month_shard(self, docs_service, index, month):
+        current = index["shards"][-1]
+        if month is None or current["key"] in (None, month):
+            # Исходный документ становится документом месяца первой записи
+            current["key"] = current["key"] or month
+            return current
+        for shard in index["shards"]:
+            if shard["key"] == month:
+                # Запись за прошлый месяц (например, из backfill) идёт в уже существующий документ
+                return shard
+        shard = self._create_shard(docs_service, month)
+        index["shards"].append(shard)
+        return shard
+
+    def _create_shard(self, docs_service, key):
+        number = len(self.index["shards"]) + 1
+        title = f"{self.agent.name} — {key}" if self.policy == 'month' else f"{self.agent.name} — часть {number}"
+        drive_service = self.get_drive_service()
+        created = execute_with_retry(
+            'drive',
+            lambda: drive_service.files().create(
+                body={'name': title, 'mimeType': DOC_MIME_TYPE, 'parents': [self.agent.drive_folder_id]},
+                fields='id',
+            ),
+            retry_statuses=RATE_LIMIT_STATUSES, retry_network_errors=False,
+        )
+        # Ссылку на продолжение вставит link_new_shards, когда записи предыдущего документа будут в нём
+        shard = {
+            "doc_id": created["id"], "key": key, "entries": 0, "chars": 0, "created_at": int(time.time()),
+            "linked": False,
+        }
+        print(f"[{self.agent.name}] Создан новый Google Doc «{title}»: {doc_url(shard['doc_id'])}")
+        return shard
+
+    def link_new_shards(self, docs_service):
+        """
+        Вставляет ссылку на продолжение в начало предыдущего документа, где читатель видит свежие записи.
+        Вызывается после записи: при пачках записи предыдущего документа, выбранные до создания нового,
+        иначе легли бы над ссылкой. Неудавшаяся вставка повторяется при следующем вызове.
+        """
+        if self.policy == 'none':
+            return
+        with self.lock:
+            if self.index is None:
+                return
+            shards = self.index["shards"]
+            # У частей из индекса, созданного до этого поля, ссылка уже вставлена
+            unlinked = [(shards[i - 1], shards[i]) for i in range(1, len(shards)) if not shards[i].get("linked", True)]
+            for previous, shard in unlinked:
+                link_text = f"Продолжение в новом документе: {doc_url(shard['doc_id'])}\n\n"
+                try:
+                    execute_with_retry(
+                        'docs',
+                        lambda: docs_service.documents().batchUpdate(documentId=previous["doc_id"], body={'requests': [
+                            {'insertText': {'location': {'index': 1}, 'text': link_text}},
+                        ]}),
+                        retry_statuses=RATE_LIMIT_STATUSES, retry_network_errors=False,
+                    )
+                    shard["linked"] = True
+                except Exception as e:
+                    print(f"Не удалось добавить ссылку на новый документ в {previous['doc_id']}: {e}")
+            if unlinked:
+                self._save()
+
+    def place(self, docs_service, content):
+        """ID документа для записи content; место под неё сразу резервируется в индексе."""
+        if self.policy == 'none':
+            return self.agent.doc_id
+        with self.lock:
+            index = self._load(docs_service)
+            shard = index["shards"][-1]
+            if self.policy == 'month':
+                shard = self._month_shard(docs_service, index, entry_month(content))
+            elif self._needs_rollover(shard, content):
+                shard = self._create_shard(docs_service, None)
+                index["shards"].append(shard)
+            shard["entries"] += 1
+            shard["chars"] += len(content)
+            self._save()
+            return shard["doc_id"]
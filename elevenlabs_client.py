@@ -0,0 +1,254 @@
+import os
+import tempfile
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from retry import request_with_retry
+from run_report import add_bytes, instrumented
+
+API_BASE_URL = os.getenv('ELEVENLABS_API_BASE_URL', "https://api.elevenlabs.io/v1")
+
+# --- КОНФИГУРАЦИЯ HTTP ---
+# Размер пула соединений должен быть не меньше числа рабочих потоков, иначе лишние соединения
+# будут открываться и закрываться на каждый запрос.
+POOL_SIZE = int(os.getenv('ELEVENLABS_POOL_SIZE', '10'))
+CONNECT_TIMEOUT = float(os.getenv('ELEVENLABS_CONNECT_TIMEOUT', '10'))
+READ_TIMEOUT = float(os.getenv('ELEVENLABS_READ_TIMEOUT', '60'))
+
+# Потоковый список (iter_conversation_windows): окна по времени начала звонка, от старых к новым.
+# Начальная ширина окна в секундах; окно, где разговоров больше SYNC_LISTING_WINDOW_MAX, делится пополам,
+# после почти пустых окон ширина растёт вдвое.
+LISTING_WINDOW_SECS = int(os.getenv('SYNC_LISTING_WINDOW_SECS', str(24 * 3600)))
+LISTING_WINDOW_MAX = int(os.getenv('SYNC_LISTING_WINDOW_MAX', '1000'))
+
+
+class ListingError(Exception):
+    """Список разговоров не удалось дочитать даже после повторов."""
+
+
+def listing_params(agent_ids, start_after=None, end_before=None):
+    params = {"page_size": 100}
+    # Серверные фильтры: по агенту (если он один) и по времени начала звонка
+    if len(agent_ids) == 1:
+        params["agent_id"] = next(iter(agent_ids))
+    if start_after is not None:
+        params["call_start_after_unix"] = start_after
+    if end_before is not None:
+        params["call_start_before_unix"] = end_before
+    return params
+
+
+def route_listing_page(agent_conversations, data, start_after=None, end_before=None):
+    """
+    Раскладывает страницу списка по агентам. Возвращает True, если нужна следующая страница:
+    она есть и текущая страница не лежит целиком ниже отметки start_after.
+    Разговоры, начавшиеся не раньше end_before, отбрасываются (если сервер не отфильтровал их сам).
+    """
+    page = data.get("conversations", [])
+    for conv in page:
+        if start_after is not None and conv.get("start_time_unix_secs", 0) < start_after:
+            continue
+        if end_before is not None and conv.get("start_time_unix_secs", 0) >= end_before:
+            continue
+        bucket = agent_conversations.get(conv.get("agent_id"))
+        if bucket is not None:
+            bucket.append(conv)
+
+    if not data.get("has_more"):
+        return False
+    if start_after is not None and page and all(
+        conv.get("start_time_unix_secs", 0) < start_after for conv in page
+    ):
+        print(f"Достигнута отметка {start_after}, дальше страницы не запрашиваем.")
+        return False
+    return True
+
+
+def report_listing(agent_conversations, pages):
+    print(f"Просмотрено страниц списка: {pages}.")
+    for agent_id, conversations in agent_conversations.items():
+        print(f"Найдено всего {len(conversations)} разговоров для агента {agent_id}.")
+
+
+class ElevenLabsClient:
+    """
+    Клиент ElevenLabs Conversational AI поверх одной requests.Session: keep-alive, пул соединений,
+    gzip и таймауты на каждый запрос. Сессию можно безопасно использовать из нескольких потоков.
+    """
+
+    def __init__(self, api_key, base_url=API_BASE_URL, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({
+            "xi-api-key": api_key or "",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        })
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _get(self, path, **kwargs):
+        url = f"{self.base_url}{path}"
+        return request_with_retry('elevenlabs', lambda: self.session.get(url, timeout=self.timeout, **kwargs))
+
+    @instrumented('list')
+    def get_new_conversations(self, agent_ids, start_after=None, end_before=None):
+        """
+        Один проход по /convai/conversations для всех агентов сразу.
+        Возвращает {agent_id: [conv, ...]}; разговоры чужих агентов отбрасываются.
+
+        start_after — unix-время, старше которого разговоры уже обработаны. Список отдаётся от новых
+        к старым, поэтому листание прекращается на первой странице, целиком лежащей ниже этой границы.
+        end_before — верхняя граница (не включительно), для выборки за период.
+        """
+        agent_conversations = {agent_id: [] for agent_id in agent_ids}
+        if not agent_conversations:
+            print("Ошибка: ID агентов не указаны.")
+            return agent_conversations
+
+        params = listing_params(agent_conversations, start_after, end_before)
+        pages = 0
+        while True:
+            try:
+                response = self._get("/convai/conversations", params=params)
+                response.raise_for_status()
+                data = response.json()
+                pages += 1
+
+                if not route_listing_page(agent_conversations, data, start_after, end_before):
+                    break
+                params["cursor"] = data.get("next_cursor")
+            except requests.RequestException as e:
+                # Неполный список нельзя обрабатывать: более старые разговоры попали бы в Doc
+                # выше уже записанных, а отметка high-water mark перескочила бы через пропуск.
+                print(f"Ошибка при запросе списка разговоров: {e}")
+                raise ListingError(f"список прерван на странице {pages + 1}: {e}") from e
+
+        report_listing(agent_conversations, pages)
+        return agent_conversations
+
+    @instrumented('list')
+    def _list_window(self, agent_ids, start_after, end_before, limit=None):
+        """
+        Разговоры с началом в [start_after, end_before) по агентам, как get_new_conversations.
+        Возвращает (разговоры, True) или (None, False), если в окне больше limit разговоров:
+        листание тогда прерывается, чтобы не держать их в памяти.
+        """
+        agent_conversations = {agent_id: [] for agent_id in agent_ids}
+        params = listing_params(agent_conversations, start_after, end_before)
+        pages = 0
+        while True:
+            try:
+                response = self._get("/convai/conversations", params=params)
+                response.raise_for_status()
+                data = response.json()
+            except requests.RequestException as e:
+                print(f"Ошибка при запросе списка разговоров: {e}")
+                raise ListingError(f"окно [{start_after}, {end_before}) прервано на странице {pages + 1}: {e}") from e
+            pages += 1
+            more = route_listing_page(agent_conversations, data, start_after, end_before)
+            if limit is not None and sum(map(len, agent_conversations.values())) > limit:
+                return None, False
+            if not more:
+                return agent_conversations, True
+            params["cursor"] = data.get("next_cursor")
+
+    def iter_conversation_windows(self, agent_ids, start_after=None, end_before=None,
+                                  window_secs=LISTING_WINDOW_SECS, window_max=LISTING_WINDOW_MAX):
+        """
+        Потоковый вариант get_new_conversations: отдаёт {agent_id: [conv, ...]} окно за окном,
+        от старых разговоров к новым, внутри окна — по времени начала. Обработка начинается после
+        первого окна, а в памяти одновременно не больше window_max разговоров (плюс страница списка).
+
+        API отдаёт список от новых к старым, поэтому хронологический порядок восстанавливается
+        сортировкой внутри окна, а не всего списка. Порядок тот же, что у сортировки всего списка.
+        """
+        if not agent_ids:
+            print("Ошибка: ID агентов не указаны.")
+            return
+        start = start_after or 0
+        stop = end_before or int(time.time()) + 1
+        span = max(window_secs, 1)
+        windows = 0
+        total = 0
+        while start < stop:
+            end = min(start + span, stop)
+            # Окно в одну секунду делить некуда: его разговоры берутся целиком
+            window, complete = self._list_window(agent_ids, start, end, window_max if end - start > 1 else None)
+            if not complete:
+                span = max((end - start) // 2, 1)
+                continue
+            count = sum(map(len, window.values()))
+            for conversations in window.values():
+                conversations.sort(key=lambda c: c.get("start_time_unix_secs", 0))
+            windows += 1
+            total += count
+            yield window
+            start = end
+            if count < window_max // 4:
+                span *= 2
+        print(f"Просмотрено окон списка: {windows}, разговоров: {total}.")
+
+    @instrumented('details')
+    def get_conversation_details(self, conversation_id):
+        try:
+            response = self._get(f"/convai/conversations/{conversation_id}")
+            if response.status_code != 200:
+                print(f"Ошибка получения деталей для {conversation_id}. Статус: {response.status_code}. Ответ: {response.text}")
+                return None
+            return response.json()
+        except Exception as e:
+            print(f"Критическая ошибка при запросе деталей для {conversation_id}: {e}")
+            return None
+
+    @instrumented('audio')
+    def download_conversation_audio(self, conversation_id):
+        try:
+            with self._get(f"/convai/conversations/{conversation_id}/audio", stream=True) as response:
+                if response.status_code != 200:
+                    print(f"Ошибка скачивания аудио для {conversation_id}. Статус: {response.status_code}. Ответ: {response.text}")
+                    return None
+
+                filename = f"{conversation_id}.mp3"
+                with open(filename, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+                    add_bytes(f.tell())
+            print(f"Аудиофайл {filename} успешно скачан.")
+            return filename
+        except Exception as e:
+            print(f"Критическая ошибка при скачивании аудио для {conversation_id}: {e}")
+            return None
+
+    @instrumented('audio')
+    def download_conversation_audio_stream(self, conversation_id, chunk_size, spool_max_bytes):
+        """Как download_conversation_audio, но возвращает перемотанный в начало SpooledTemporaryFile."""
+        try:
+            with self._get(f"/convai/conversations/{conversation_id}/audio", stream=True) as response:
+                if response.status_code != 200:
+                    print(f"Ошибка скачивания аудио для {conversation_id}. Статус: {response.status_code}. Ответ: {response.text}")
+                    return None
+
+                buffer = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+                try:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        buffer.write(chunk)
+                    size = buffer.tell()
+                    buffer.seek(0)
+                    add_bytes(size)
+                except Exception:
+                    buffer.close()
+                    raise
+            print(f"Аудио для {conversation_id} скачано в буфер ({size} байт).")
+            return buffer
+        except Exception as e:
+            print(f"Критическая ошибка при скачивании аудио для {conversation_id}: {e}")
+            return None
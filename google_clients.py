@@ -0,0 +1,62 @@
+import json
+import threading
+
+# Клиенты Google Docs/Drive создаются лениво. Импорт googleapiclient и google.oauth2 занимает
+# заметную долю запуска, а запуск, не нашедший новых разговоров, к Google не обращается вовсе —
+# поэтому библиотеки импортируются только при первом реальном вызове API.
+# Клиенты собираются из discovery-документа, который поставляется вместе с googleapiclient
+# (без запроса к discovery-сервису); разобранный документ кэшируется на весь процесс.
+
+SCOPES = ['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive']
+
+_discovery_docs = {}
+_lock = threading.Lock()
+
+
+def load_credentials(creds_json_str):
+    from google.oauth2.service_account import Credentials
+
+    return Credentials.from_service_account_info(json.loads(creds_json_str), scopes=SCOPES)
+
+
+def discovery_document(api, version):
+    """Статический discovery-документ API (разбирается один раз на процесс)."""
+    key = (api, version)
+    with _lock:
+        if key not in _discovery_docs:
+            from googleapiclient.discovery_cache import get_static_doc
+
+            content = get_static_doc(api, version)
+            if content is None:
+                raise ValueError(f"Нет статического discovery-документа для {api} {version}")
+            _discovery_docs[key] = json.loads(content)
+        return _discovery_docs[key]
+
+
+def build_service(api, version, credentials):
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(discovery_document(api, version), credentials=credentials)
+
+
+class LazyService:
+    """
+    Заменяет клиент googleapiclient, пока он не понадобился: настоящий клиент собирается при первом
+    обращении к атрибуту (documents(), files() и т.п.). Сам клиент по-прежнему не потокобезопасен.
+    """
+
+    def __init__(self, api, version, get_credentials):
+        self._api = api
+        self._version = version
+        self._get_credentials = get_credentials
+        self._service = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        with self._lock:
+            if self._service is None:
+                self._service = build_service(self._api, self._version, self._get_credentials())
+            return self._service
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
@@ -0,0 +1,243 @@
+import heapq
+import os
+import queue
+import sys
+import threading
+from contextlib import ExitStack
+from dataclasses import dataclass
+from typing import Any
+
+from elevenlabs_client import ListingError
+import run_report
+from run_report import agent_context
+from state_store import agent_lock, open_state_store
+from sync_engine import (
+    AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES, DOC_BATCH_MODE,
+    append_doc_entry, close_details_source, configured_agents, get_details_source, get_elevenlabs_client,
+    get_google_services, get_thread_drive_service, known_audio_link, list_agent_conversations,
+    load_agents_from_env, make_entry, save_high_water_mark, select_new_conversations, upload_audio, write_doc_entries,
+)
+
+# Конвейер: детали -> аудио -> Drive -> Google Doc. Этапы работают в своих потоках и связаны
+# ограниченными очередями: пока аудио разговора N грузится на Drive, для N+1 уже качаются детали
+# и аудио, а быстрый этап упирается в полную очередь и ждёт (память ограничена размером очередей).
+PIPELINE_QUEUE_SIZE = int(os.getenv('SYNC_PIPELINE_QUEUE_SIZE', '4'))
+PIPELINE_WORKERS = {
+    'details': int(os.getenv('SYNC_PIPELINE_DETAILS_WORKERS', '1')),
+    'audio': int(os.getenv('SYNC_PIPELINE_AUDIO_WORKERS', '1')),
+    'upload': int(os.getenv('SYNC_PIPELINE_UPLOAD_WORKERS', '1')),
+}
+
+_DONE = object()
+
+
+@dataclass
+class PipelineItem:
+    seq: int
+    agent: Any
+    conv_id: str
+    details: Any = None
+    audio: Any = None
+    audio_link: Any = None
+    entry: Any = None
+    failed: bool = False
+
+    def __lt__(self, other):
+        return self.seq < other.seq
+
+
+def _fetch_details(item):
+    item.details = get_details_source().get(item.conv_id)
+    if not item.details:
+        print(f"Не удалось получить детали для {item.conv_id}. Пропускаем.")
+        item.failed = True
+
+
+def _fetch_audio(item):
+    # Уже загруженное аудио (кэш или поиск на Drive) не скачивается повторно
+    item.audio_link = known_audio_link(item.agent, item.conv_id)
+    if item.audio_link:
+        return
+    item.audio = get_elevenlabs_client().download_conversation_audio_stream(
+        item.conv_id, AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES,
+    )
+    if not item.audio:
+        print(f"Не удалось скачать аудио для {item.conv_id}. Пропускаем.")
+        item.failed = True
+
+
+def _upload(item):
+    if not item.audio_link:
+        try:
+            item.audio_link = upload_audio(
+                get_thread_drive_service(), item.audio, item.conv_id, item.agent.drive_folder_id,
+            )
+        finally:
+            item.audio.close()
+            item.audio = None
+    if not item.audio_link:
+        item.failed = True
+        return
+    item.entry = make_entry(item.agent, item.details, item.audio_link)
+    item.details = None
+
+
+class _Stage:
+    """Пул потоков одного этапа. Неудачные элементы идут дальше без обработки, чтобы порядок не рвался."""
+
+    def __init__(self, name, func, inbox, outbox, workers, downstream_workers):
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.workers = max(workers, 1)
+        self.downstream_workers = downstream_workers
+        self.remaining = self.workers
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"pipeline-{name}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                with self.lock:
+                    self.remaining -= 1
+                    last = self.remaining == 0
+                # Последний завершившийся поток передаёт сигнал окончания каждому потоку следующего этапа
+                if last:
+                    for _ in range(self.downstream_workers):
+                        self.outbox.put(_DONE)
+                return
+            if not item.failed:
+                with agent_context(item.agent.name):
+                    try:
+                        self.func(item)
+                    except Exception as e:
+                        print(f"[{item.agent.name}] Ошибка на этапе {self.name} для {item.conv_id}: {e}")
+                        item.failed = True
+            self.outbox.put(item)
+
+
+def run_pipeline(agent_runs, docs_service, doc_batch=None):
+    """
+    agent_runs — [(agent, new_ids, store, done_ids), ...]; new_ids уже в хронологическом порядке.
+    Запись в Google Doc выполняется в вызывающем потоке строго по порядку поступления в конвейер.
+    """
+    doc_batch = DOC_BATCH_MODE if doc_batch is None else doc_batch
+    queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(4)]
+    stages = [
+        _Stage('details', _fetch_details, queues[0], queues[1], PIPELINE_WORKERS['details'], PIPELINE_WORKERS['audio']),
+        _Stage('audio', _fetch_audio, queues[1], queues[2], PIPELINE_WORKERS['audio'], PIPELINE_WORKERS['upload']),
+        _Stage('upload', _upload, queues[2], queues[3], PIPELINE_WORKERS['upload'], 1),
+    ]
+    for stage in stages:
+        stage.start()
+    # Этап деталей подгружает следующие разговоры заранее, как и sync_engine
+    get_details_source().schedule(conv_id for _, new_ids, _, _ in agent_runs for conv_id in new_ids)
+
+    def feed():
+        seq = 0
+        for agent, new_ids, _, _ in agent_runs:
+            for conv_id in new_ids:
+                print(f"\n--- [{agent.name}] Обработка новой записи: {conv_id} ---")
+                queues[0].put(PipelineItem(seq, agent, conv_id))
+                seq += 1
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+
+    feeder = threading.Thread(target=feed, name="pipeline-feed", daemon=True)
+    feeder.start()
+
+    runs_by_agent = {agent.name: (store, done_ids) for agent, _, store, done_ids in agent_runs}
+    pending_doc_entries = {agent.name: [] for agent, _, _, _ in agent_runs}
+    reorder = []
+    next_seq = 0
+    while True:
+        item = queues[3].get()
+        if item is _DONE:
+            break
+        # При нескольких потоках на этапе элементы могут обгонять друг друга — возвращаем порядок
+        heapq.heappush(reorder, item)
+        while reorder and reorder[0].seq == next_seq:
+            _deliver(heapq.heappop(reorder), docs_service, doc_batch, runs_by_agent, pending_doc_entries)
+            next_seq += 1
+    feeder.join()
+
+    for agent, new_ids, store, done_ids in agent_runs:
+        if pending_doc_entries[agent.name]:
+            with agent_context(agent.name):
+                written_ids = write_doc_entries(docs_service, agent, pending_doc_entries[agent.name])
+            store.mark_processed(written_ids)
+            done_ids.update(written_ids)
+
+
+def _deliver(item, docs_service, doc_batch, runs_by_agent, pending_doc_entries):
+    agent = item.agent
+    store, done_ids = runs_by_agent[agent.name]
+    if item.failed:
+        store.mark_failed(item.conv_id, "fetch")
+        return
+    entry = item.entry
+    if doc_batch:
+        pending_doc_entries[agent.name].append((item.conv_id, entry))
+        return
+    with agent_context(agent.name):
+        appended = append_doc_entry(docs_service, agent, entry)
+    if not appended:
+        store.mark_failed(item.conv_id, "doc")
+        return
+    store.mark_processed([item.conv_id])
+    done_ids.add(item.conv_id)
+
+
+def main(agents=None):
+    print("Начало работы скрипта (конвейер)...")
+    agents = load_agents_from_env() if agents is None else configured_agents(agents)
+    if not agents:
+        sys.exit("Не настроено ни одного агента.")
+
+    docs_service, drive_service = get_google_services()
+    if not all([docs_service, drive_service]):
+        sys.exit("Не удалось подключиться к сервисам Google.")
+
+    try:
+        conversations_by_agent = list_agent_conversations(agents)
+    except ListingError as e:
+        sys.exit(f"Не удалось получить список разговоров: {e}")
+
+    agent_runs = []
+    conversations_of = {}
+    with ExitStack() as stack:
+        # Блокировки агентов держим весь запуск, чтобы backfill.py не писал те же разговоры одновременно
+        for agent in agents:
+            stack.enter_context(agent_lock(agent))
+        for agent in agents:
+            store = open_state_store(agent)
+            stack.callback(store.close)
+            conversations = conversations_by_agent.get(agent.agent_id, [])
+            with agent_context(agent.name):
+                new_ids, done_ids = select_new_conversations(agent, conversations, store)
+            agent_runs.append((agent, new_ids, store, done_ids))
+            conversations_of[agent.name] = conversations
+
+        run_pipeline(agent_runs, docs_service)
+
+        for agent, new_ids, store, done_ids in agent_runs:
+            conversations = conversations_of[agent.name]
+            if conversations and not new_ids:
+                print(f"[{agent.name}] Новых записей для обработки не найдено.")
+            save_high_water_mark(agent, conversations, done_ids)
+
+    close_details_source()
+    run_report.finish_run()
+    print("Работа скрипта завершена.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from run_report import note_api_call, note_retry
+
+# --- КОНФИГУРАЦИЯ ПОВТОРОВ ---
+RETRY_MAX_ATTEMPTS = int(os.getenv('SYNC_RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY = float(os.getenv('SYNC_RETRY_BASE_DELAY', '1'))
+RETRY_MAX_DELAY = float(os.getenv('SYNC_RETRY_MAX_DELAY', '60'))
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# 429 означает, что запрос отклонён до выполнения — его безопасно повторять даже для записи в Doc
+RATE_LIMIT_STATUSES = frozenset({429})
+
+# Запросов в секунду на каждый внешний сервис (общие для всех потоков и агентов)
+RATE_LIMITS = {
+    'elevenlabs': float(os.getenv('SYNC_RATE_ELEVENLABS', '10')),
+    'docs': float(os.getenv('SYNC_RATE_DOCS', '1')),
+    'drive': float(os.getenv('SYNC_RATE_DRIVE', '5')),
+}
+
+# Сколько повторов было на каждый сервис за время работы процесса
+retry_counts = Counter()
+_retry_counts_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: acquire() ждёт, пока не появится свободный токен.
+    acquire_async() делает то же самое, не блокируя цикл событий.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _try_take(self):
+        """Берёт токен и возвращает 0 или сообщает, сколько секунд ждать до следующего."""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._try_take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._try_take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+limiters = {name: TokenBucket(rate) for name, rate in RATE_LIMITS.items()}
+
+
+def parse_retry_after(value):
+    """Retry-After бывает числом секунд или HTTP-датой. None, если заголовка нет или он непонятен."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Экспоненциальная задержка с полным jitter; Retry-After от сервера имеет приоритет."""
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _note_retry(upstream, attempt, reason, retry_after=None):
+    delay = backoff_delay(attempt, retry_after)
+    with _retry_counts_lock:
+        retry_counts[upstream] += 1
+    note_retry(upstream)
+    print(f"[{upstream}] {reason}. Повтор {attempt + 1}/{RETRY_MAX_ATTEMPTS - 1} через {delay:.1f} с.")
+    return delay
+
+
+def _wait_before_retry(upstream, attempt, reason, retry_after=None):
+    time.sleep(_note_retry(upstream, attempt, reason, retry_after))
+
+
+def request_with_retry(upstream, send):
+    """
+    Выполняет send() (запрос через requests) с учётом лимита и повторами на сетевые ошибки и 429/5xx.
+    Возвращает последний ответ — вызывающий код сам решает, что делать с неуспешным статусом.
+    """
+    limiter = limiters.get(upstream)
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        last_attempt = attempt == RETRY_MAX_ATTEMPTS - 1
+        if limiter:
+            limiter.acquire()
+        note_api_call(upstream)
+        try:
+            response = send()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if last_attempt:
+                raise
+            _wait_before_retry(upstream, attempt, f"Сетевая ошибка: {e}")
+            continue
+        if response.status_code in RETRYABLE_STATUSES and not last_attempt:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            response.close()
+            _wait_before_retry(upstream, attempt, f"Статус {response.status_code}", retry_after)
+            continue
+        return response
+
+
+def execute_with_retry(upstream, build_request, retry_statuses=RETRYABLE_STATUSES, retry_network_errors=True):
+    """
+    Выполняет запрос googleapiclient, заново собирая его через build_request() на каждую попытку.
+    Для неидемпотентных записей (Docs batchUpdate) передавайте retry_statuses=RATE_LIMIT_STATUSES
+    и retry_network_errors=False, чтобы не вставить одну запись дважды.
+    """
+    # googleapiclient импортирован к этому моменту: build_request() собирает его запрос
+    from googleapiclient.errors import HttpError
+
+    limiter = limiters.get(upstream)
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        last_attempt = attempt == RETRY_MAX_ATTEMPTS - 1
+        if limiter:
+            limiter.acquire()
+        note_api_call(upstream)
+        try:
+            return build_request().execute()
+        except HttpError as e:
+            status = int(getattr(e.resp, 'status', 0) or 0)
+            if status not in retry_statuses or last_attempt:
+                raise
+            _wait_before_retry(upstream, attempt, f"Статус {status}", parse_retry_after(e.resp.get('retry-after')))
+        except OSError as e:
+            if not retry_network_errors or last_attempt:
+                raise
+            _wait_before_retry(upstream, attempt, f"Сетевая ошибка: {e}")
+
+
+async def async_request_with_retry(upstream, send, network_errors):
+    """
+    Асинхронный вариант request_with_retry: send() — корутина, возвращающая ответ aiohttp,
+    network_errors — исключения клиента, после которых запрос можно повторить.
+    """
+    limiter = limiters.get(upstream)
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        last_attempt = attempt == RETRY_MAX_ATTEMPTS - 1
+        if limiter:
+            await limiter.acquire_async()
+        note_api_call(upstream)
+        try:
+            response = await send()
+        except network_errors as e:
+            if last_attempt:
+                raise
+            await asyncio.sleep(_note_retry(upstream, attempt, f"Сетевая ошибка: {e!r}"))
+            continue
+        if response.status in RETRYABLE_STATUSES and not last_attempt:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            response.release()
+            await asyncio.sleep(_note_retry(upstream, attempt, f"Статус {response.status}", retry_after))
+            continue
+        return response
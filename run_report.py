@@ -0,0 +1,223 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Замеры по этапам синхронизации: время, байты, вызовы API, повторы и ошибки — отдельно для каждого агента.
+# В конце запуска отчёт пишется в JSON и/или Prometheus textfile (для node_exporter).
+REPORT_JSON_PATH = os.getenv('SYNC_REPORT_JSON')
+REPORT_PROM_PATH = os.getenv('SYNC_REPORT_PROM')
+
+ALL_AGENTS = '*'
+
+_current_agent = ContextVar('sync_report_agent', default=ALL_AGENTS)
+_current_stage = ContextVar('sync_report_stage', default=None)
+
+# source_bytes и encode_seconds — у этапов обработки данных (перекодирование аудио): объём на входе
+# и время работы кодировщика (ffmpeg) по часам, без ожидания свободного слота, которое входит в seconds.
+_COUNTERS = ('calls', 'errors', 'seconds', 'bytes', 'api_calls', 'retries', 'source_bytes', 'encode_seconds')
+
+
+class RunReport:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stages = {}
+        self.seconds_max = {}
+        self.upstreams = {}
+
+    def _stage(self, agent, stage):
+        key = (agent, stage)
+        if key not in self.stages:
+            self.stages[key] = dict.fromkeys(_COUNTERS, 0)
+        return self.stages[key]
+
+    def record(self, agent, stage, seconds, ok):
+        with self.lock:
+            stats = self._stage(agent, stage)
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            if not ok:
+                stats['errors'] += 1
+            self.seconds_max[(agent, stage)] = max(self.seconds_max.get((agent, stage), 0.0), seconds)
+
+    def add(self, counter, value=1, upstream=None):
+        """Добавляет value к счётчику текущего этапа (агент и этап берутся из контекста вызова)."""
+        stage = _current_stage.get()
+        with self.lock:
+            if stage is not None:
+                self._stage(_current_agent.get(), stage)[counter] += value
+            if upstream:
+                per_upstream = self.upstreams.setdefault(upstream, {'api_calls': 0, 'retries': 0})
+                if counter in per_upstream:
+                    per_upstream[counter] += value
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def to_dict(self):
+        finished_at = self.finished_at or time.time()
+        with self.lock:
+            agents = {}
+            for (agent, stage), stats in sorted(self.stages.items()):
+                agents.setdefault(agent, {})[stage] = dict(
+                    stats,
+                    seconds=round(stats['seconds'], 4),
+                    encode_seconds=round(stats['encode_seconds'], 4),
+                    seconds_max=round(self.seconds_max.get((agent, stage), 0.0), 4),
+                )
+            return {
+                "started_at": self.started_at,
+                "finished_at": finished_at,
+                "duration_seconds": round(finished_at - self.started_at, 3),
+                "agents": agents,
+                "upstreams": dict(sorted(self.upstreams.items())),
+            }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = []
+        metrics = [
+            ('calls', 'sync_stage_calls_total', 'Number of stage invocations'),
+            ('errors', 'sync_stage_errors_total', 'Stage invocations that failed'),
+            ('seconds', 'sync_stage_seconds_total', 'Time spent in the stage'),
+            ('seconds_max', 'sync_stage_seconds_max', 'Slowest single stage invocation'),
+            ('bytes', 'sync_stage_bytes_total', 'Bytes transferred by the stage'),
+            ('api_calls', 'sync_stage_api_calls_total', 'HTTP requests made by the stage, retries included'),
+            ('retries', 'sync_stage_retries_total', 'Retried HTTP requests'),
+            ('source_bytes', 'sync_stage_source_bytes_total', 'Bytes consumed by the stage before processing'),
+            ('encode_seconds', 'sync_stage_encode_seconds_total', 'Wall-clock time spent in the encoder subprocess'),
+        ]
+        for field, name, help_text in metrics:
+            lines.append(f"# HELP {name} {help_text}.")
+            lines.append(f"# TYPE {name} {'gauge' if field == 'seconds_max' else 'counter'}")
+            for agent, stages in data['agents'].items():
+                for stage, stats in stages.items():
+                    lines.append(f'{name}{{agent="{agent}",stage="{stage}"}} {stats[field]}')
+        for field in ('api_calls', 'retries'):
+            name = f"sync_upstream_{field}_total"
+            lines.append(f"# TYPE {name} counter")
+            for upstream, stats in data['upstreams'].items():
+                lines.append(f'{name}{{upstream="{upstream}"}} {stats[field]}')
+        lines.append("# TYPE sync_run_duration_seconds gauge")
+        lines.append(f"sync_run_duration_seconds {data['duration_seconds']}")
+        lines.append("# TYPE sync_run_finished_timestamp_seconds gauge")
+        lines.append(f"sync_run_finished_timestamp_seconds {round(data['finished_at'], 3)}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prom_path=None):
+        json_path = json_path or REPORT_JSON_PATH
+        prom_path = prom_path or REPORT_PROM_PATH
+        if json_path:
+            _write_atomic(json_path, json.dumps(self.to_dict(), indent=2, ensure_ascii=False))
+        if prom_path:
+            _write_atomic(prom_path, self.to_prometheus())
+
+    def print_summary(self):
+        data = self.to_dict()
+        print(f"Отчёт о запуске ({data['duration_seconds']} с):")
+        for agent, stages in data['agents'].items():
+            parts = [
+                f"{stage} {stats['calls']}x/{stats['seconds']:.2f}с"
+                + (f"/{stats['source_bytes'] // 1024}КБ→" if stats['source_bytes'] else "")
+                + (f"/{stats['bytes'] // 1024}КБ" if stats['bytes'] else "")
+                + (f"/ошибок {stats['errors']}" if stats['errors'] else "")
+                + (f"/повторов {stats['retries']}" if stats['retries'] else "")
+                for stage, stats in stages.items()
+            ]
+            print(f"  [{agent}] " + ", ".join(parts))
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+report = RunReport()
+
+
+def reset():
+    """Новый отчёт (для долгоживущих процессов, где запусков несколько)."""
+    global report
+    report = RunReport()
+    return report
+
+
+@contextmanager
+def agent_context(agent_name):
+    token = _current_agent.set(agent_name)
+    try:
+        yield
+    finally:
+        _current_agent.reset(token)
+
+
+def instrumented(stage):
+    """
+    Замеряет время вызова и записывает его на этап stage текущего агента.
+    Исключение или результат None считаются ошибкой — так функции синхронизации сообщают о неудаче.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                token = _current_stage.set(stage)
+                started = time.perf_counter()
+                result = None
+                try:
+                    result = await func(*args, **kwargs)
+                    return result
+                finally:
+                    _current_stage.reset(token)
+                    report.record(_current_agent.get(), stage, time.perf_counter() - started, result is not None)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                token = _current_stage.set(stage)
+                started = time.perf_counter()
+                result = None
+                try:
+                    result = func(*args, **kwargs)
+                    return result
+                finally:
+                    _current_stage.reset(token)
+                    report.record(_current_agent.get(), stage, time.perf_counter() - started, result is not None)
+        return wrapper
+    return decorator
+
+
+def add_bytes(count):
+    report.add('bytes', count)
+
+
+def add_source_bytes(count):
+    report.add('source_bytes', count)
+
+
+def add_encode_seconds(seconds):
+    report.add('encode_seconds', seconds)
+
+
+def note_api_call(upstream):
+    report.add('api_calls', 1, upstream)
+
+
+def note_retry(upstream):
+    report.add('retries', 1, upstream)
+
+
+def finish_run():
+    """Закрывает отчёт текущего запуска: сводка в лог и файлы SYNC_REPORT_JSON / SYNC_REPORT_PROM."""
+    report.finish()
+    report.print_summary()
+    try:
+        report.write()
+    except OSError as e:
+        print(f"Не удалось записать отчёт о запуске: {e}")
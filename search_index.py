@@ -0,0 +1,289 @@
+"""
+Полнотекстовый поиск по транскриптам (SQLite FTS5), заполняется по ходу синхронизации.
+
+    python search_index.py search "вернуть деньги" --agent agent_1 --since 2024-03-01
+    python search_index.py rebuild --agent 1 --since 2024-01-01          # из ElevenLabs API
+    python search_index.py rebuild --from-archive data/archive           # из локального архива (archive.py)
+
+Включается переменной SYNC_SEARCH_INDEX (путь к файлу базы). Реплики лежат в обычной таблице turns,
+а FTS5-индекс turns_fts построен над ней как external content: переиндексация разговора — это
+удаление его строк по индексу conversation_id, без полного просмотра FTS-таблицы.
+"""
+import argparse
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from archive import iter_conversations, parse_time
+
+SEARCH_INDEX_PATH = os.getenv('SYNC_SEARCH_INDEX')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id TEXT PRIMARY KEY,
+    agent TEXT NOT NULL,
+    agent_id TEXT,
+    start_time_unix_secs INTEGER,
+    summary TEXT,
+    audio_link TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_agent_time ON conversations (agent, start_time_unix_secs);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    turn INTEGER NOT NULL,
+    role TEXT,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_conversation ON turns (conversation_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(
+    message, content='turns', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS turns_ai AFTER INSERT ON turns BEGIN
+    INSERT INTO turns_fts (rowid, message) VALUES (new.id, new.message);
+END;
+CREATE TRIGGER IF NOT EXISTS turns_ad AFTER DELETE ON turns BEGIN
+    INSERT INTO turns_fts (turns_fts, rowid, message) VALUES ('delete', old.id, old.message);
+END;
+'''
+
+# Краткое содержание индексируется как реплика с номером -1
+SUMMARY_TURN = -1
+
+
+def fts_query(text):
+    """Каждое слово — отдельная фраза в кавычках: пользовательский ввод не ломает синтаксис FTS5."""
+    words = [word.replace('"', '""') for word in text.split()]
+    return ' '.join(f'"{word}"' for word in words)
+
+
+class SearchIndex:
+    def __init__(self, path):
+        self.path = path
+        # Индекс пополняют рабочие потоки синхронизации; запросы к соединению идут под блокировкой
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+
+    def add(self, agent_name, details, audio_link):
+        conv_id = details.get("conversation_id")
+        if not conv_id:
+            return
+        metadata = details.get("metadata") or {}
+        summary = ((details.get("analysis") or {}).get("transcript_summary") or "").strip()
+        rows = [(conv_id, SUMMARY_TURN, 'summary', summary)] if summary else []
+        rows.extend(
+            (conv_id, i, turn.get("role"), (turn.get("message") or "").strip())
+            for i, turn in enumerate(details.get("transcript") or [])
+            if (turn.get("message") or "").strip()
+        )
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM turns WHERE conversation_id = ?', (conv_id,))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO conversations '
+                '(conversation_id, agent, agent_id, start_time_unix_secs, summary, audio_link, indexed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (conv_id, agent_name, details.get("agent_id"), metadata.get("start_time_unix_secs"),
+                 summary, audio_link, time.time()),
+            )
+            self.conn.executemany(
+                'INSERT INTO turns (conversation_id, turn, role, message) VALUES (?, ?, ?, ?)', rows,
+            )
+
+    def add_record(self, record):
+        """Запись из локального архива (archive.archive_record)."""
+        self.add(record["agent"], {
+            "conversation_id": record["conversation_id"],
+            "agent_id": record.get("agent_id"),
+            "metadata": {"start_time_unix_secs": record.get("start_time_unix_secs")},
+            "analysis": {"transcript_summary": record.get("summary")},
+            "transcript": record.get("transcript") or [],
+        }, record.get("audio_link"))
+
+    def search(self, text, agent=None, since=None, until=None, limit=20, raw=False, turns_per_conversation=3):
+        """
+        Разговоры, у которых в одной реплике (или в summary) встречаются все слова text (raw=True —
+        синтаксис FTS5 как есть), от самых релевантных. Для каждого — до turns_per_conversation реплик.
+        """
+        where, params = ['turns_fts MATCH ?'], [text if raw else fts_query(text)]
+        if agent:
+            where.append('c.agent = ?')
+            params.append(agent)
+        if since:
+            where.append('c.start_time_unix_secs >= ?')
+            params.append(since)
+        if until:
+            where.append('c.start_time_unix_secs < ?')
+            params.append(until)
+        sql = (
+            "SELECT c.conversation_id, c.agent, c.start_time_unix_secs, c.audio_link, t.turn, t.role, "
+            "snippet(turns_fts, 0, '[', ']', '…', 16), bm25(turns_fts) AS rank "
+            "FROM turns_fts JOIN turns t ON t.id = turns_fts.rowid "
+            "JOIN conversations c ON c.conversation_id = t.conversation_id "
+            f"WHERE {' AND '.join(where)} ORDER BY rank"
+        )
+        results = {}
+        with self.lock:
+            for conv_id, agent_name, start_ts, audio_link, turn, role, snippet, rank in self.conn.execute(sql, params):
+                result = results.get(conv_id)
+                if result is None:
+                    if len(results) >= limit:
+                        continue
+                    result = results[conv_id] = {
+                        "conversation_id": conv_id, "agent": agent_name, "start_time_unix_secs": start_ts,
+                        "audio_link": audio_link, "matches": [],
+                    }
+                if len(result["matches"]) < turns_per_conversation:
+                    result["matches"].append({"turn": turn, "role": role, "snippet": snippet})
+        return list(results.values())
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+
+    def reset(self, agent=None):
+        with self.lock, self.conn:
+            if agent:
+                self.conn.execute(
+                    'DELETE FROM turns WHERE conversation_id IN (SELECT conversation_id FROM conversations WHERE agent = ?)',
+                    (agent,),
+                )
+                self.conn.execute('DELETE FROM conversations WHERE agent = ?', (agent,))
+            else:
+                self.conn.execute('DELETE FROM turns')
+                self.conn.execute('DELETE FROM conversations')
+                self.conn.execute("INSERT INTO turns_fts (turns_fts) VALUES ('rebuild')")
+
+    def optimize(self):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO turns_fts (turns_fts) VALUES ('optimize')")
+
+    def close(self):
+        self.conn.close()
+
+
+class NullSearchIndex:
+    """Индекс выключен (SYNC_SEARCH_INDEX не задан)."""
+
+    def add(self, agent_name, details, audio_link):
+        pass
+
+    def close(self):
+        pass
+
+
+def open_search_index(path=None):
+    path = SEARCH_INDEX_PATH if path is None else path
+    if not path:
+        return NullSearchIndex()
+    index = SearchIndex(path)
+    atexit.register(index.close)
+    return index
+
+
+# --- CLI ---
+
+def _rebuild_from_api(index, args):
+    # Импорт здесь: поиск по готовому индексу не должен требовать конфигурации синхронизации
+    from sync_engine import SYNC_WORKERS, agent_from_env, get_audio_cache, get_elevenlabs_client
+
+    agent = agent_from_env(args.agent)
+    if not agent.agent_id:
+        sys.exit(f"ID агента {args.agent} не указан.")
+    client = get_elevenlabs_client()
+    conversations = client.get_new_conversations([agent.agent_id], start_after=args.since, end_before=args.until)
+    conv_ids = [conv.get('conversation_id') for conv in conversations[agent.agent_id] if conv.get('conversation_id')]
+    if args.reset:
+        index.reset(agent.name)
+    # Ссылки на аудио берутся из кэша загрузок (audio_cache.py) — без обращений к Drive
+    audio_cache = get_audio_cache()
+
+    def index_one(conv_id):
+        details = client.get_conversation_details(conv_id)
+        if not details:
+            return False
+        index.add(agent.name, details, audio_cache.link_for_conversation(conv_id))
+        return True
+
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        indexed = sum(executor.map(index_one, conv_ids))
+    print(f"[{agent.name}] Проиндексировано {indexed} из {len(conv_ids)} разговоров.")
+
+
+def _rebuild_from_archive(index, args):
+    if args.reset:
+        index.reset()
+    indexed = 0
+    for record in iter_conversations(args.from_archive, since=args.since, until=args.until):
+        index.add_record(record)
+        indexed += 1
+    print(f"Проиндексировано {indexed} разговоров из архива {args.from_archive}.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index', default=SEARCH_INDEX_PATH, help="файл индекса (по умолчанию SYNC_SEARCH_INDEX)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    search = commands.add_parser('search', help="найти разговоры")
+    search.add_argument('query')
+    search.add_argument('--agent', help="имя агента, например agent_1")
+    search.add_argument('--since', type=parse_time)
+    search.add_argument('--until', type=parse_time)
+    search.add_argument('--limit', type=int, default=20)
+    search.add_argument('--raw', action='store_true', help="запрос в синтаксисе FTS5 (OR, NEAR, префиксы*)")
+    search.add_argument('--json', action='store_true', help="вывод в JSON Lines")
+
+    rebuild = commands.add_parser('rebuild', help="заполнить индекс прошлыми разговорами")
+    rebuild.add_argument('--agent', help="номер агента N (для загрузки из API)")
+    rebuild.add_argument('--from-archive', help="каталог локального архива вместо API")
+    rebuild.add_argument('--since', type=parse_time)
+    rebuild.add_argument('--until', type=parse_time)
+    rebuild.add_argument('--reset', action='store_true', help="сначала удалить из индекса старые записи")
+
+    args = parser.parse_args(argv)
+    if not args.index:
+        sys.exit("Файл индекса не задан: укажите --index или SYNC_SEARCH_INDEX.")
+    index = SearchIndex(args.index)
+    try:
+        if args.command == 'search':
+            started = time.perf_counter()
+            try:
+                results = index.search(args.query, args.agent, args.since, args.until, args.limit, args.raw)
+            except sqlite3.OperationalError as e:
+                sys.exit(f"Ошибка в запросе: {e}")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            for result in results:
+                if args.json:
+                    print(json.dumps(result, ensure_ascii=False))
+                    continue
+                start_ts = result["start_time_unix_secs"]
+                when = datetime.fromtimestamp(start_ts).strftime('%Y-%m-%d %H:%M:%S') if start_ts else "N/A"
+                print(f"{when}  [{result['agent']}] {result['conversation_id']}  {result['audio_link'] or ''}")
+                for match in result["matches"]:
+                    print(f"    {match['role']}: {match['snippet']}")
+            if not args.json:
+                print(f"Найдено разговоров: {len(results)} за {elapsed_ms:.1f} мс (в индексе {index.count()}).")
+        elif args.from_archive:
+            _rebuild_from_archive(index, args)
+            index.optimize()
+        elif args.agent:
+            _rebuild_from_api(index, args)
+            index.optimize()
+        else:
+            sys.exit("Для rebuild укажите --agent или --from-archive.")
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка между процессами недоступна
+    fcntl = None
+
+# Хранилища списка обработанных разговоров.
+#   text   — прежний формат agent_N_processed_ids.txt: по одному ID в строке, только дозапись.
+#            При каждом запуске файл читается целиком, так что время старта растёт с историей.
+#            Оставлен для локальных запусков; workflow работает на sqlite.
+#   sqlite — одна база на всех агентов, с индексом, статусами и временем; при первом открытии
+#            для агента в неё переносятся ID из его .txt файла.
+STATE_BACKEND = os.getenv('SYNC_STATE_BACKEND', 'text')
+STATE_DB_PATH = os.getenv('SYNC_STATE_DB', 'sync_state.sqlite3')
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Ограничение SQLite на число параметров в одном запросе
+_SQL_CHUNK = 500
+
+
+class TextStateStore:
+    def __init__(self, path):
+        self.path = path
+        self._ids = None
+        self._file = None
+
+    def _load(self):
+        if self._ids is None:
+            self._ids = set()
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    self._ids.update(line.strip() for line in f if line.strip())
+        return self._ids
+
+    def count(self):
+        return len(self._load())
+
+    def filter_new(self, conversation_ids):
+        ids = self._load()
+        return [conv_id for conv_id in conversation_ids if conv_id not in ids]
+
+    def mark_processed(self, conversation_ids):
+        ids = self._load()
+        if self._file is None:
+            self._file = open(self.path, 'a', buffering=1)
+        for conv_id in conversation_ids:
+            if conv_id not in ids:
+                self._file.write(conv_id + '\n')
+                ids.add(conv_id)
+
+    def mark_failed(self, conversation_id, error=None):
+        # В текстовом формате хранятся только успешно обработанные ID
+        pass
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SqliteStateStore:
+    def __init__(self, db_path, agent_name, legacy_text_path=None):
+        self.db_path = db_path
+        self.agent_name = agent_name
+        # Соединение может перейти в другой поток (например, в этап записи конвейера),
+        # но обращения к нему всегда последовательны.
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+        if legacy_text_path:
+            self.migrate_from_text(legacy_text_path)
+
+    def _create_schema(self):
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    agent TEXT NOT NULL,
+                    conversation_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (agent, conversation_id)
+                ) WITHOUT ROWID
+            ''')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS conversations_status ON conversations (agent, status, updated_at)'
+            )
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS migrations (
+                    agent TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    imported INTEGER NOT NULL,
+                    migrated_at REAL NOT NULL,
+                    PRIMARY KEY (agent, source)
+                )
+            ''')
+
+    def migrate_from_text(self, text_path):
+        """Разовый перенос ID из agent_N_processed_ids.txt. Повторные вызовы ничего не делают."""
+        source = os.path.basename(text_path)
+        already = self.conn.execute(
+            'SELECT 1 FROM migrations WHERE agent = ? AND source = ?', (self.agent_name, source)
+        ).fetchone()
+        if already or not os.path.exists(text_path):
+            return 0
+        now = time.time()
+        with open(text_path, 'r') as f:
+            ids = [line.strip() for line in f if line.strip()]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO conversations (agent, conversation_id, status, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((self.agent_name, conv_id, STATUS_DONE, now, now) for conv_id in ids),
+            )
+            self.conn.execute(
+                'INSERT INTO migrations (agent, source, imported, migrated_at) VALUES (?, ?, ?, ?)',
+                (self.agent_name, source, len(ids), now),
+            )
+        print(f"[{self.agent_name}] Перенесено {len(ids)} ID из {text_path} в {self.db_path}.")
+        return len(ids)
+
+    def count(self):
+        return self.conn.execute(
+            'SELECT COUNT(*) FROM conversations WHERE agent = ? AND status = ?', (self.agent_name, STATUS_DONE)
+        ).fetchone()[0]
+
+    def filter_new(self, conversation_ids):
+        done = set()
+        for i in range(0, len(conversation_ids), _SQL_CHUNK):
+            chunk = conversation_ids[i:i + _SQL_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            done.update(row[0] for row in self.conn.execute(
+                f'SELECT conversation_id FROM conversations WHERE agent = ? AND status = ? '
+                f'AND conversation_id IN ({placeholders})',
+                (self.agent_name, STATUS_DONE, *chunk),
+            ))
+        return [conv_id for conv_id in conversation_ids if conv_id not in done]
+
+    def mark_processed(self, conversation_ids):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO conversations (agent, conversation_id, status, attempts, created_at, updated_at) '
+                'VALUES (?, ?, ?, 1, ?, ?) '
+                'ON CONFLICT (agent, conversation_id) DO UPDATE SET '
+                'status = excluded.status, attempts = attempts + 1, last_error = NULL, updated_at = excluded.updated_at',
+                ((self.agent_name, conv_id, STATUS_DONE, now, now) for conv_id in conversation_ids),
+            )
+
+    def mark_failed(self, conversation_id, error=None):
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO conversations (agent, conversation_id, status, attempts, last_error, created_at, updated_at) '
+                'VALUES (?, ?, ?, 1, ?, ?, ?) '
+                'ON CONFLICT (agent, conversation_id) DO UPDATE SET '
+                'status = excluded.status, attempts = attempts + 1, last_error = excluded.last_error, '
+                'updated_at = excluded.updated_at '
+                'WHERE status != ?',
+                (self.agent_name, conversation_id, STATUS_FAILED, error, now, now, STATUS_DONE),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+@contextmanager
+def agent_lock(agent):
+    """
+    Межпроцессная блокировка агента на время отбора и записи его разговоров.
+    Держат её cron-синхронизация и каждая порция backfill.py, поэтому они не пишут в Doc один и тот же разговор.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = os.path.splitext(agent.state_file)[0] + '.lock'
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_state_store(agent, backend=None):
+    backend = backend or STATE_BACKEND
+    if backend == 'sqlite':
+        return SqliteStateStore(STATE_DB_PATH, agent.state_name, legacy_text_path=agent.processed_ids_file)
+    if backend == 'text':
+        return TextStateStore(agent.processed_ids_file)
+    raise ValueError(f"Неизвестное хранилище состояния: {backend}")
@@ -0,0 +1,163 @@
+"""
+Параллельный запуск всех настроенных агентов в одном процессе.
+
+    python supervisor.py
+
+Каждый агент обрабатывается в своём потоке со своими клиентами Docs/Drive; учётные данные Google и пул
+соединений ElevenLabs общие. Ошибка одного агента не останавливает остальных.
+
+Список разговоров каждый агент читает сам, окнами по времени (sync_engine.process_agents_streaming):
+обработка начинается после первого окна, а в памяти одно окно агента, а не вся история.
+SYNC_LISTING_STREAM=0 — прежний режим: один общий список всех агентов до начала обработки.
+
+У каждого агента бюджет времени SYNC_AGENT_BUDGET секунд (AGENT_<N>_BUDGET — для отдельного агента):
+по его истечении агент не начинает новые разговоры, а оставшиеся ждут следующего запуска. Если агент
+не уложился и в SYNC_AGENT_GRACE секунд сверх бюджета (завис на запросе), супервизор перестаёт его
+ждать и завершает процесс.
+
+Код выхода: 0 — все агенты отработали (в том числе остановленные по бюджету), 1 — хотя бы один
+упал с ошибкой или завис.
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+
+from elevenlabs_client import ListingError
+import run_report
+from sync_engine import (
+    SYNC_WORKERS, close_details_source, configured_agents, get_elevenlabs_client, get_google_services, list_agent_conversations,
+    load_agents_from_env, process_agent, process_agents_streaming,
+)
+
+AGENT_BUDGET = float(os.getenv('SYNC_AGENT_BUDGET', '900'))
+AGENT_GRACE = float(os.getenv('SYNC_AGENT_GRACE', '120'))
+# В супервизоре потоковый список включён по умолчанию (в sync_engine.main — выключен)
+LISTING_STREAM = os.getenv('SYNC_LISTING_STREAM', '1') == '1'
+
+STATUS_OK = 'ok'
+STATUS_PARTIAL = 'partial'
+STATUS_FAILED = 'failed'
+STATUS_HUNG = 'hung'
+
+
+@dataclass
+class AgentOutcome:
+    agent: object
+    budget: float
+    status: str = STATUS_HUNG
+    new_items: int = 0
+    seconds: float = 0.0
+    error: str = ""
+
+
+def agent_budget(agent):
+    """AGENT_<N>_BUDGET для агента agent_<N>, иначе SYNC_AGENT_BUDGET."""
+    number = agent.name.rpartition('_')[2]
+    value = os.getenv(f'AGENT_{number}_BUDGET') if number.isdigit() else None
+    return float(value) if value else AGENT_BUDGET
+
+
+def _run_agent(outcome, conversations, workers):
+    """conversations=None — агент читает свой список окнами."""
+    agent = outcome.agent
+    started = time.monotonic()
+    deadline = started + outcome.budget if outcome.budget > 0 else None
+    # Клиенты googleapiclient не потокобезопасны: у агента свои Docs/Drive, учётные данные общие на процесс
+    docs_service, drive_service = get_google_services()
+    try:
+        if conversations is None:
+            outcome.new_items = process_agents_streaming([agent], docs_service, drive_service, workers, deadline=deadline)
+        else:
+            outcome.new_items = process_agent(agent, conversations, docs_service, drive_service, workers, deadline=deadline)
+        outcome.status = STATUS_PARTIAL if deadline is not None and time.monotonic() >= deadline else STATUS_OK
+    except Exception as e:
+        traceback.print_exc()
+        outcome.error = repr(e)
+        outcome.status = STATUS_FAILED
+    finally:
+        outcome.seconds = time.monotonic() - started
+
+
+def run_agents(agents, conversations_by_agent=None, workers=None, grace=AGENT_GRACE):
+    """
+    Обрабатывает агентов параллельно. Возвращает AgentOutcome в порядке agents.
+    conversations_by_agent=None — каждый агент читает свой список окнами.
+    """
+    workers = workers or SYNC_WORKERS
+    outcomes = [AgentOutcome(agent, agent_budget(agent)) for agent in agents]
+    # Потоки-демоны: зависший агент не должен держать процесс после того, как супервизор перестал его ждать
+    threads = [
+        threading.Thread(
+            target=_run_agent, args=(
+                outcome,
+                None if conversations_by_agent is None else conversations_by_agent.get(outcome.agent.agent_id, []),
+                workers,
+            ),
+            name=f"agent-{outcome.agent.name}", daemon=True,
+        )
+        for outcome in outcomes
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for outcome, thread in zip(outcomes, threads):
+        if outcome.budget > 0:
+            thread.join(max(started + outcome.budget + grace - time.monotonic(), 0))
+        else:
+            thread.join()
+        if thread.is_alive():
+            outcome.seconds = time.monotonic() - started
+            print(f"[{outcome.agent.name}] Не завершился за {outcome.budget + grace:.0f} с; перестаём ждать.")
+    return outcomes
+
+
+def print_outcomes(outcomes):
+    print(f"{'агент':<16}{'статус':<10}{'новых':>7}{'сек':>9}")
+    for outcome in outcomes:
+        print(f"{outcome.agent.name:<16}{outcome.status:<10}{outcome.new_items:>7}{outcome.seconds:>9.1f}"
+              f"{'  ' + outcome.error if outcome.error else ''}")
+
+
+def exit_code(outcomes):
+    return 1 if any(outcome.status in (STATUS_FAILED, STATUS_HUNG) for outcome in outcomes) else 0
+
+
+def main(agents=None, workers=None):
+    print("Начало работы супервизора...")
+    agents = load_agents_from_env() if agents is None else configured_agents(agents)
+    if not agents:
+        sys.exit("Не настроено ни одного агента.")
+    workers = workers or SYNC_WORKERS
+
+    if not all(get_google_services()):
+        sys.exit("Не удалось подключиться к сервисам Google.")
+    # Пул соединений ElevenLabs один на все потоки всех агентов
+    get_elevenlabs_client(concurrency=len(agents) * workers)
+
+    conversations_by_agent = None
+    if not LISTING_STREAM:
+        try:
+            conversations_by_agent = list_agent_conversations(agents)
+        except ListingError as e:
+            sys.exit(f"Не удалось получить список разговоров: {e}")
+
+    outcomes = run_agents(agents, conversations_by_agent, workers)
+    close_details_source()
+    run_report.finish_run()
+    print_outcomes(outcomes)
+    code = exit_code(outcomes)
+    print("Работа супервизора завершена." if code == 0 else "Работа супервизора завершена с ошибками.")
+    return code
+
+
+if __name__ == '__main__':
+    code = main()
+    if any(thread.name.startswith('agent-') and thread.is_alive() for thread in threading.enumerate()):
+        # Зависший агент: при обычном выходе интерпретатор ждал бы потоки его пулов
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+    sys.exit(code)
@@ -0,0 +1,788 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
+from datetime import datetime
+import sys
+
+from archive import archive_record, open_archive_writer
+from audio_cache import content_sha256, file_sha256, open_audio_cache
+from details import DetailsSource, open_details_cache
+from doc_format import DOC_STYLE, format_doc_entry, format_transcript, insert_requests
+from doc_shards import DocShards
+from elevenlabs_client import POOL_SIZE as ELEVENLABS_POOL_SIZE, ElevenLabsClient, ListingError
+from google_clients import LazyService, build_service, load_credentials
+from retry import RATE_LIMIT_STATUSES, execute_with_retry
+import run_report
+from run_report import add_bytes, agent_context, instrumented
+from search_index import open_search_index
+from state_store import agent_lock, open_state_store
+from transcode import AUDIO_EXTENSIONS, SOURCE_MIME_TYPE, transcode_audio, transcoding_enabled
+
+# --- КОНФИГУРАЦИЯ ---
+ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
+GOOGLE_CREDENTIALS_JSON_STR = os.getenv('GOOGLE_CREDENTIALS_JSON')
+
+# Запас (в секундах) ниже отметки high-water mark: звонки, которые начались раньше отметки,
+# но появились в списке позже (ещё шли во время прошлого запуска), всё равно будут найдены.
+LISTING_OVERLAP_SECS = int(os.getenv('SYNC_LISTING_OVERLAP_SECS', '3600'))
+
+# Сколько разговоров обрабатывать параллельно (детали, аудио, Drive). 1 — строго по очереди.
+SYNC_WORKERS = max(int(os.getenv('SYNC_WORKERS', '1')), 1)
+
+# Копить записи для Google Doc и отправлять их за один (или несколько) batchUpdate в конце запуска.
+DOC_BATCH_MODE = os.getenv('SYNC_DOC_BATCH', '0') == '1'
+DOC_BATCH_MAX_REQUESTS = int(os.getenv('SYNC_DOC_BATCH_MAX_REQUESTS', '200'))
+DOC_BATCH_MAX_CHARS = int(os.getenv('SYNC_DOC_BATCH_MAX_CHARS', '500000'))
+
+# Аудио передаётся из ElevenLabs в Drive через буфер в памяти, без файла в рабочей папке.
+# Файл (анонимный, удаляется сам) появляется только если запись больше SYNC_AUDIO_SPOOL_MAX_BYTES.
+AUDIO_STREAMING = os.getenv('SYNC_AUDIO_STREAMING', '1') == '1'
+AUDIO_SPOOL_MAX_BYTES = int(os.getenv('SYNC_AUDIO_SPOOL_MAX_BYTES', str(32 * 1024 * 1024)))
+# Размер куска при скачивании и при resumable-загрузке; Drive требует кратность 256 КБ
+_DRIVE_CHUNK_ALIGN = 256 * 1024
+AUDIO_CHUNK_SIZE = max(
+    -(-int(os.getenv('SYNC_AUDIO_CHUNK_SIZE', str(1024 * 1024))) // _DRIVE_CHUNK_ALIGN) * _DRIVE_CHUNK_ALIGN,
+    _DRIVE_CHUNK_ALIGN,
+)
+
+# Перед скачиванием аудио искать {conversation_id}.mp3 в папке агента на Drive — один запрос
+# метаданных на разговор; находит файлы, загруженные до появления локального кэша (audio_cache.py).
+DRIVE_LOOKUP = os.getenv('SYNC_DRIVE_LOOKUP', '0') == '1'
+
+# Читать список разговоров окнами по времени и обрабатывать каждое окно сразу, не дожидаясь всего списка
+# (ElevenLabsClient.iter_conversation_windows): в памяти не весь список, а одно окно.
+LISTING_STREAM = os.getenv('SYNC_LISTING_STREAM', '0') == '1'
+
+# Номера агентов через запятую ("1,2,3"). Если не задано — берём все AGENT_<N>_ID из окружения.
+SYNC_AGENTS = os.getenv('SYNC_AGENTS')
+
+
+@dataclass
+class AgentConfig:
+    agent_id: str
+    doc_id: str
+    drive_folder_id: str
+    processed_ids_file: str
+    name: str = ""
+    state_file: str = ""
+    doc_index_file: str = ""
+    # Ключ агента в SQLite-хранилище состояния; отдельный у пересборки документа (backfill.py --doc-id)
+    state_name: str = ""
+
+    def __post_init__(self):
+        if not self.name:
+            self.name = self.agent_id
+        if not self.state_name:
+            self.state_name = self.name
+        base = os.path.splitext(self.processed_ids_file)[0].replace('_processed_ids', '')
+        if not self.state_file:
+            self.state_file = base + '_state.json'
+        if not self.doc_index_file:
+            self.doc_index_file = base + '_docs.json'
+
+
+def agent_from_env(number):
+    """Собирает конфигурацию агента из переменных AGENT_<N>_* (как в старых agent_N_main.py)."""
+    return AgentConfig(
+        agent_id=os.getenv(f'AGENT_{number}_ID'),
+        doc_id=os.getenv(f'AGENT_{number}_DOC_ID'),
+        drive_folder_id=os.getenv(f'AGENT_{number}_DRIVE_FOLDER_ID'),
+        processed_ids_file=f'agent_{number}_processed_ids.txt',
+        name=f'agent_{number}',
+    )
+
+
+def load_agents_from_env():
+    if SYNC_AGENTS:
+        numbers = [n.strip() for n in SYNC_AGENTS.split(',') if n.strip()]
+    else:
+        numbers = sorted(
+            (m.group(1) for m in (re.fullmatch(r'AGENT_(\d+)_ID', key) for key in os.environ) if m),
+            key=int,
+        )
+    return configured_agents(agent_from_env(number) for number in numbers)
+
+
+def configured_agents(agents):
+    """Агенты с указанным ID: без него список разговоров запросился бы по всему аккаунту."""
+    configured = []
+    for agent in agents:
+        if not agent.agent_id:
+            print(f"Ошибка: ID агента {agent.name} не указан. Пропускаем.")
+            continue
+        configured.append(agent)
+    return configured
+
+
+_elevenlabs_client = None
+_google_credentials = None
+_audio_cache = None
+_singletons_lock = threading.Lock()
+_doc_shards = {}
+_archive_writer = None
+_search_index = None
+_details_source = None
+_thread_state = threading.local()
+# Время начала последнего полного списка разговоров по agent_id (см. save_high_water_mark)
+_listing_times = {}
+
+def get_elevenlabs_client(concurrency=None):
+    """
+    Один клиент (и один пул соединений) на весь процесс, общий для всех агентов и потоков.
+    concurrency — сколько потоков будут обращаться к нему одновременно; учитывается при первом вызове.
+    """
+    global _elevenlabs_client
+    with _singletons_lock:
+        if _elevenlabs_client is None:
+            pool_size = max(ELEVENLABS_POOL_SIZE, concurrency or SYNC_WORKERS)
+            _elevenlabs_client = ElevenLabsClient(ELEVENLABS_API_KEY, pool_size=pool_size)
+    return _elevenlabs_client
+
+def get_audio_cache():
+    global _audio_cache
+    with _singletons_lock:
+        if _audio_cache is None:
+            _audio_cache = open_audio_cache()
+    return _audio_cache
+
+def get_archive_writer():
+    global _archive_writer
+    with _singletons_lock:
+        if _archive_writer is None:
+            _archive_writer = open_archive_writer()
+    return _archive_writer
+
+def get_search_index():
+    global _search_index
+    with _singletons_lock:
+        if _search_index is None:
+            _search_index = open_search_index()
+    return _search_index
+
+def get_details_source():
+    """Детали разговоров с учётом данных списка, предзагрузки и дискового кэша (details.py)."""
+    global _details_source
+    with _singletons_lock:
+        if _details_source is None:
+            _details_source = DetailsSource(
+                lambda conv_id: get_elevenlabs_client().get_conversation_details(conv_id), open_details_cache(),
+            )
+    return _details_source
+
+def close_details_source():
+    """Конец запуска: останавливает предзагрузку деталей и забывает незабранные результаты."""
+    with _singletons_lock:
+        details_source = _details_source
+    if details_source is not None:
+        details_source.close()
+
+def get_doc_shards(agent):
+    """Ротация документов агента (doc_shards.py); один объект на агента и документ на процесс."""
+    with _singletons_lock:
+        key = (agent.name, agent.doc_id, agent.doc_index_file)
+        if key not in _doc_shards:
+            _doc_shards[key] = DocShards(agent, lambda: get_thread_drive_service())
+        return _doc_shards[key]
+
+def get_google_credentials():
+    global _google_credentials
+    with _singletons_lock:
+        if _google_credentials is None:
+            _google_credentials = load_credentials(GOOGLE_CREDENTIALS_JSON_STR)
+    return _google_credentials
+
+def get_google_services():
+    """
+    Docs и Drive клиенты, общие для всех агентов. Собираются при первом обращении, поэтому запуск
+    без новых разговоров не тратит время на импорт и сборку клиентов Google.
+    """
+    try:
+        json.loads(GOOGLE_CREDENTIALS_JSON_STR)
+    except (TypeError, ValueError) as e:
+        print(f"Ошибка аутентификации в Google: {e}")
+        return None, None
+    return LazyService('docs', 'v1', get_google_credentials), LazyService('drive', 'v3', get_google_credentials)
+
+def get_thread_drive_service():
+    """Клиенты googleapiclient не потокобезопасны, поэтому у каждого рабочего потока свой Drive-клиент."""
+    if getattr(_thread_state, 'drive_service', None) is None:
+        _thread_state.drive_service = build_service('drive', 'v3', get_google_credentials())
+    return _thread_state.drive_service
+
+def load_agent_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Не удалось прочитать состояние {state_file}: {e}. Начинаем с полного просмотра.")
+        return {}
+
+def save_agent_state(state_file, state):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+def listing_mark(agent):
+    """
+    Отметка агента для нижней границы списка: high-water mark или время, на которое список был просмотрен
+    целиком и всё найденное обработано (scanned_through), — что позже. Так агент без разговоров
+    не заставляет каждый запуск листать всю историю и не держит границу для остальных агентов.
+    """
+    state = load_agent_state(agent.state_file)
+    return max(state.get("high_water_mark") or 0, state.get("scanned_through") or 0) or None
+
+def note_listing_time(agents, listed_at):
+    """Запоминает время начала полного списка; save_high_water_mark сохранит его, если всё обработано."""
+    for agent in agents:
+        _listing_times[agent.agent_id] = listed_at
+
+def listing_start_after(high_water_marks):
+    """
+    Нижняя граница времени для списка разговоров: самая старая отметка среди агентов минус запас.
+    None — хотя бы у одного агента отметки ещё нет, нужен полный просмотр.
+    """
+    if not high_water_marks or any(not mark for mark in high_water_marks):
+        return None
+    return max(min(high_water_marks) - LISTING_OVERLAP_SECS, 0)
+
+# files().create неидемпотентен: после 5xx или обрыва связи файл мог уже сохраниться, и повтор создал бы
+# второй такой же. Повторяются только отказы по лимиту; в остальных случаях разговор повторится
+# в следующий запуск, а кэш аудио и поиск на Drive (SYNC_DRIVE_LOOKUP) найдут уже загруженный файл.
+DRIVE_CREATE_RETRY = {'retry_statuses': RATE_LIMIT_STATUSES, 'retry_network_errors': False}
+
+@instrumented('upload')
+def upload_stream_to_drive(drive_service, fileobj, filename, folder_id, mime_type=SOURCE_MIME_TYPE):
+    try:
+        from googleapiclient.http import MediaIoBaseUpload
+
+        file_metadata = {'name': filename, 'parents': [folder_id]}
+        media = MediaIoBaseUpload(fileobj, mimetype=mime_type, chunksize=AUDIO_CHUNK_SIZE, resumable=True)
+        file = execute_with_retry('drive', lambda: drive_service.files().create(
+            body=file_metadata, media_body=media, fields='id, webViewLink'), **DRIVE_CREATE_RETRY)
+        add_bytes(media.size())
+        print(f"Файл {filename} загружен на Google Drive. Ссылка: {file.get('webViewLink')}")
+        return file.get('webViewLink')
+    except Exception as e:
+        print(f"Ошибка загрузки на Google Drive: {e}")
+        return None
+
+@instrumented('upload')
+def upload_to_drive(drive_service, filename, folder_id):
+    try:
+        from googleapiclient.http import MediaFileUpload
+
+        file_metadata = {'name': filename, 'parents': [folder_id]}
+        media = MediaFileUpload(filename, mimetype='audio/mpeg', resumable=True)
+        file = execute_with_retry('drive', lambda: drive_service.files().create(
+            body=file_metadata, media_body=media, fields='id, webViewLink'), **DRIVE_CREATE_RETRY)
+        add_bytes(media.size())
+        print(f"Файл {filename} загружен на Google Drive. Ссылка: {file.get('webViewLink')}")
+        return file.get('webViewLink')
+    except Exception as e:
+        print(f"Ошибка загрузки на Google Drive: {e}")
+        return None
+
+@instrumented('lookup')
+def find_drive_files(drive_service, folder_id, filenames):
+    """Файлы с одним из имён filenames в папке folder_id. Пустой список — не найдено, None — ошибка запроса."""
+    try:
+        names = " or ".join(f"name = '{filename}'" for filename in filenames)
+        query = f"({names}) and '{folder_id}' in parents and trashed = false"
+        result = execute_with_retry('drive', lambda: drive_service.files().list(
+            q=query, fields='files(id, webViewLink)', pageSize=1))
+        return result.get('files', [])
+    except Exception as e:
+        print(f"Ошибка поиска {filenames[0]} на Google Drive: {e}")
+        return None
+
+def known_audio_link(agent, conv_id, drive_service=None):
+    """Ссылка на уже загруженное аудио разговора (из кэша или, при SYNC_DRIVE_LOOKUP=1, из папки Drive)."""
+    cache = get_audio_cache()
+    link = cache.link_for_conversation(conv_id)
+    if link:
+        print(f"Аудио для {conv_id} уже загружено ранее: {link}")
+        return link
+    if not DRIVE_LOOKUP:
+        return None
+    # Файл мог быть загружен как исходный MP3 или перекодированным (transcode.py)
+    filenames = [f"{conv_id}{extension}" for extension in AUDIO_EXTENSIONS]
+    files = find_drive_files(drive_service or get_thread_drive_service(), agent.drive_folder_id, filenames)
+    if not files:
+        return None
+    link = files[0].get('webViewLink')
+    cache.put(conv_id, link, file_id=files[0].get('id'))
+    print(f"Аудио для {conv_id} найдено на Google Drive: {link}")
+    return link
+
+def upload_audio(drive_service, audio, conv_id, folder_id):
+    """
+    Загружает аудио (буфер или путь к файлу) на Drive, если файла с тем же содержимым там ещё нет.
+    При SYNC_TRANSCODE загружается перекодированный файл. Возвращает ссылку и запоминает её в кэше
+    по conversation_id и sha256 исходного аудио — повтор находится ещё до перекодирования.
+    """
+    if isinstance(audio, str):
+        sha256 = file_sha256(audio)
+    else:
+        sha256 = content_sha256(audio)
+    cache = get_audio_cache()
+    link = cache.link_for_hash(sha256)
+    encoded = None
+    if not link and transcoding_enabled():
+        encoded = transcode_audio(audio)
+    if link:
+        print(f"Такое же аудио уже загружено на Google Drive: {link}")
+    elif encoded:
+        try:
+            link = upload_stream_to_drive(
+                drive_service, encoded.file, f"{conv_id}{encoded.extension}", folder_id, encoded.mime_type,
+            )
+        finally:
+            encoded.close()
+    elif isinstance(audio, str):
+        link = upload_to_drive(drive_service, audio, folder_id)
+    else:
+        link = upload_stream_to_drive(drive_service, audio, f"{conv_id}.mp3", folder_id)
+    if link:
+        cache.put(conv_id, link, sha256=sha256)
+    return link
+
+@instrumented('doc')
+def append_to_google_doc(docs_service, doc_id, content, ranges=None):
+    try:
+        requests_body = insert_requests(content, ranges)
+        execute_with_retry(
+            'docs',
+            lambda: docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests_body}),
+            retry_statuses=RATE_LIMIT_STATUSES, retry_network_errors=False,
+        )
+        add_bytes(len(content.encode()))
+        print("Запись успешно добавлена в Google Doc.")
+        return True
+    except Exception as e:
+        print(f"Ошибка добавления в Google Doc: {e}")
+
+def split_doc_batches(pending):
+    """
+    Режет [(conv_id, text, оформление), ...] на пачки не длиннее DOC_BATCH_MAX_REQUESTS запросов
+    и DOC_BATCH_MAX_CHARS символов.
+    """
+    batch, batch_requests, batch_chars = [], 0, 0
+    for conv_id, content, ranges in pending:
+        requests = insert_requests(content, ranges)
+        too_many = batch_requests + len(requests) > DOC_BATCH_MAX_REQUESTS
+        if batch and (too_many or batch_chars + len(content) > DOC_BATCH_MAX_CHARS):
+            yield batch
+            batch, batch_requests, batch_chars = [], 0, 0
+        batch.append((conv_id, content, requests))
+        batch_requests += len(requests)
+        batch_chars += len(content)
+    if batch:
+        yield batch
+
+@instrumented('doc')
+def write_doc_batches(docs_service, doc_id, pending):
+    """
+    Отправляет накопленные за запуск записи пачками batchUpdate.
+    Каждая запись — отдельный insertText в индекс 1 (с оформлением — сразу за ним), в хронологическом
+    порядке, как и при поштучной отправке, поэтому итоговый документ не отличается. Возвращает ID записанных разговоров.
+    """
+    written_ids = []
+    batch_sizes = []
+    for batch in split_doc_batches(pending):
+        requests_body = [request for _, _, requests in batch for request in requests]
+        try:
+            execute_with_retry(
+                'docs',
+                lambda: docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests_body}),
+                retry_statuses=RATE_LIMIT_STATUSES, retry_network_errors=False,
+            )
+        except Exception as e:
+            # Дальше не пишем: более новые записи оказались бы выше несохранённых
+            print(f"Ошибка добавления пачки из {len(batch)} записей в Google Doc: {e}")
+            break
+        add_bytes(sum(len(content.encode()) for _, content, _ in batch))
+        written_ids.extend(conv_id for conv_id, _, _ in batch)
+        batch_sizes.append(len(batch))
+    print(
+        f"Google Doc: записано {len(written_ids)} из {len(pending)} записей "
+        f"за {len(batch_sizes)} запросов batchUpdate (размеры пачек: {batch_sizes})."
+    )
+    return written_ids
+
+def append_doc_entry(docs_service, agent, entry):
+    """Пишет запись в текущий документ агента (с учётом ротации). True при успехе, None при ошибке."""
+    content, ranges = format_doc_entry(entry, styled=DOC_STYLE == 'styled')
+    shards = get_doc_shards(agent)
+    try:
+        doc_id = shards.place(docs_service, content)
+    except Exception as e:
+        print(f"Ошибка выбора Google Doc для записи: {e}")
+        return None
+    appended = append_to_google_doc(docs_service, doc_id, content, ranges)
+    shards.link_new_shards(docs_service)
+    return appended
+
+def write_doc_entries(docs_service, agent, pending):
+    """
+    write_doc_batches с учётом ротации: подряд идущие записи одного документа уходят одной серией пачек.
+    pending — [(conv_id, запись conversation_entry), ...]. Возвращает ID записанных разговоров;
+    после первой неудачи дальше не пишет.
+    """
+    shards = get_doc_shards(agent)
+    written_ids = []
+    runs = []
+    try:
+        for conv_id, entry in pending:
+            content, ranges = format_doc_entry(entry, styled=DOC_STYLE == 'styled')
+            doc_id = shards.place(docs_service, content)
+            if not runs or runs[-1][0] != doc_id:
+                runs.append((doc_id, []))
+            runs[-1][1].append((conv_id, content, ranges))
+    except Exception as e:
+        print(f"Ошибка выбора Google Doc для записи: {e}")
+    for doc_id, run in runs:
+        run_written = write_doc_batches(docs_service, doc_id, run)
+        written_ids.extend(run_written)
+        if len(run_written) < len(run):
+            break
+    # Ссылки на новые документы — только теперь, над уже записанными пачками предыдущих
+    shards.link_new_shards(docs_service)
+    return written_ids
+
+def advance_high_water_mark(conversations, done_ids, high_water_mark, last_conversation_id):
+    """
+    Отметка сдвигается только по непрерывному префиксу обработанных разговоров (по возрастанию времени):
+    после первой неудачи всё, что новее, будет снова просмотрено в следующем запуске.
+    """
+    for conv in conversations:
+        conv_id = conv.get('conversation_id')
+        if not conv_id:
+            continue
+        if conv_id not in done_ids:
+            break
+        conv_ts = conv.get("start_time_unix_secs", 0)
+        if conv_ts >= high_water_mark:
+            high_water_mark = conv_ts
+            last_conversation_id = conv_id
+    return high_water_mark, last_conversation_id
+
+def conversation_entry(details, audio_link):
+    """Поля записи Google Doc из деталей разговора и ссылки на аудио."""
+    start_ts = details.get("metadata", {}).get("start_time_unix_secs", 0)
+    start_time_str = datetime.fromtimestamp(start_ts).strftime('%Y-%m-%d %H:%M:%S') if start_ts else "N/A"
+
+    summary_text = (details.get("analysis") or {}).get("transcript_summary", "").strip()
+
+    # Подписи спикеров (для оформления в Doc) считаются тем же проходом, что и текст
+    if DOC_STYLE == 'styled':
+        transcript_text, labels = format_transcript(details.get("transcript", []), with_labels=True)
+    else:
+        transcript_text, labels = format_transcript(details.get("transcript", [])), None
+    if not transcript_text:
+        transcript_text, labels = "Транскрибация пуста.", None
+
+    return {
+        "summary": summary_text,
+        "transcript": transcript_text,
+        "audio_link": audio_link,
+        "start_time_str": start_time_str,
+        "labels": labels,
+    }
+
+def make_entry(agent, details, audio_link):
+    """
+    Запись для Google Doc. Если включены локальный архив (SYNC_ARCHIVE_DIR) и поисковый индекс
+    (SYNC_SEARCH_INDEX), разговор сохраняется и туда.
+    """
+    try:
+        get_archive_writer().write(archive_record(agent.name, details, audio_link))
+    except OSError as e:
+        print(f"Не удалось сохранить разговор в локальный архив: {e}")
+    try:
+        get_search_index().add(agent.name, details, audio_link)
+    except sqlite3.Error as e:
+        print(f"Не удалось добавить разговор в поисковый индекс: {e}")
+    return conversation_entry(details, audio_link)
+
+def fetch_conversation(agent, conv_id, drive_service=None):
+    """
+    Всё, что можно делать параллельно: детали, аудио и загрузка на Drive.
+    Возвращает готовую запись для Google Doc или None, если разговор нужно пропустить.
+    """
+    with agent_context(agent.name):
+        return _fetch_conversation(agent, conv_id, drive_service)
+
+def _fetch_conversation(agent, conv_id, drive_service):
+    print(f"\n--- [{agent.name}] Обработка новой записи: {conv_id} ---")
+    if drive_service is None:
+        drive_service = get_thread_drive_service()
+
+    client = get_elevenlabs_client()
+    details = get_details_source().get(conv_id)
+    if not details:
+        print(f"Не удалось получить детали для {conv_id}. Пропускаем.")
+        return None
+
+    audio_link = known_audio_link(agent, conv_id, drive_service)
+    if audio_link:
+        return make_entry(agent, details, audio_link)
+
+    if AUDIO_STREAMING:
+        audio = client.download_conversation_audio_stream(conv_id, AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES)
+    else:
+        audio = client.download_conversation_audio(conv_id)
+    if not audio:
+        print(f"Не удалось скачать аудио для {conv_id}. Пропускаем.")
+        return None
+
+    try:
+        audio_link = upload_audio(drive_service, audio, conv_id, agent.drive_folder_id)
+    finally:
+        if AUDIO_STREAMING:
+            audio.close()
+        else:
+            os.remove(audio)
+
+    if not audio_link:
+        return None
+    return make_entry(agent, details, audio_link)
+
+def process_agent(agent, conversations, docs_service, drive_service, workers=None, doc_batch=None, deadline=None,
+                  save_mark=True):
+    """
+    Обрабатывает уже отфильтрованные разговоры одного агента. Возвращает число новых записей.
+
+    При workers > 1 детали, аудио и загрузка на Drive идут в пуле потоков, а запись в Google Doc
+    остаётся последовательной и в хронологическом порядке — документ получается тем же.
+    При doc_batch записи копятся в памяти и уходят в Google Doc несколькими batchUpdate в конце.
+    deadline (time.monotonic()) — после него новые разговоры не начинаются, остальные ждут следующего запуска.
+    save_mark=False — не сдвигать high-water mark (в более раннем окне потокового списка остался пропуск).
+    """
+    workers = workers or SYNC_WORKERS
+    doc_batch = DOC_BATCH_MODE if doc_batch is None else doc_batch
+    # Пока агент обрабатывается, backfill.py ждёт (и наоборот) — иначе оба процесса запишут один разговор
+    with agent_lock(agent):
+        store = open_state_store(agent)
+        try:
+            with agent_context(agent.name):
+                return _process_agent(
+                    agent, conversations, docs_service, drive_service, workers, doc_batch, store, deadline, save_mark,
+                )
+        finally:
+            store.close()
+
+def select_new_conversations(agent, conversations, store):
+    """
+    Сортирует разговоры агента по времени (на месте) и делит их ID на новые и уже обработанные.
+    Возвращает (new_ids в хронологическом порядке, done_ids).
+    """
+    print(f"[{agent.name}] Загружено {store.count()} уже обработанных ID.")
+    if not conversations:
+        print(f"[{agent.name}] Разговоров для агента не найдено.")
+        return [], set()
+
+    conversations.sort(key=lambda c: c.get("start_time_unix_secs", 0))
+
+    listing_ids = [conv.get('conversation_id') for conv in conversations if conv.get('conversation_id')]
+    new_ids = store.filter_new(listing_ids)
+    new_set = set(new_ids)
+    # Данные списка по новым разговорам избавляют от части запросов деталей
+    get_details_source().remember_listing(conv for conv in conversations if conv.get('conversation_id') in new_set)
+    return new_ids, set(listing_ids).difference(new_set)
+
+def save_high_water_mark(agent, conversations, done_ids):
+    """
+    Сдвигает high-water mark агента. Если список был полным (list_agent_conversations) и все разговоры
+    агента из него обработаны, сохраняет и время начала списка (scanned_through) — даже без разговоров.
+    """
+    state = load_agent_state(agent.state_file)
+    changed = False
+    high_water_mark, last_conversation_id = advance_high_water_mark(
+        conversations, done_ids, state.get("high_water_mark", 0), state.get("last_conversation_id"),
+    )
+    if high_water_mark and high_water_mark != state.get("high_water_mark"):
+        state.update(high_water_mark=high_water_mark, last_conversation_id=last_conversation_id)
+        changed = True
+        print(f"[{agent.name}] Отметка high-water mark: {high_water_mark} ({last_conversation_id}).")
+    listed_at = _listing_times.pop(agent.agent_id, None)
+    if listed_at and listed_at > state.get("scanned_through", 0) and all(
+        conv.get('conversation_id') in done_ids for conv in conversations if conv.get('conversation_id')
+    ):
+        state["scanned_through"] = listed_at
+        changed = True
+    if changed:
+        save_agent_state(agent.state_file, state)
+
+def _process_agent(agent, conversations, docs_service, drive_service, workers, doc_batch, store, deadline=None,
+                   save_mark=True):
+    new_ids, done_ids = select_new_conversations(agent, conversations, store)
+    if not conversations:
+        if save_mark:
+            save_high_water_mark(agent, conversations, done_ids)
+        return 0
+
+    process_conversations(agent, new_ids, docs_service, drive_service, workers, doc_batch, store, done_ids, deadline)
+
+    new_items_found = len(new_ids)
+    if new_items_found == 0:
+        print(f"[{agent.name}] Новых записей для обработки не найдено.")
+
+    if save_mark:
+        save_high_water_mark(agent, conversations, done_ids)
+    return new_items_found
+
+def process_conversations(agent, new_ids, docs_service, drive_service, workers, doc_batch, store, done_ids,
+                          deadline=None):
+    """Загружает разговоры new_ids (в хронологическом порядке) и пишет их в Doc; успешные ID добавляются в done_ids."""
+    pending_doc_entries = []
+    get_details_source().schedule(new_ids)
+
+    with ExitStack() as stack:
+        executor = None
+        if workers > 1 and len(new_ids) > 1:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+            # executor.map отдаёт результаты в порядке new_ids, т.е. хронологически
+            fetched = executor.map(lambda conv_id: fetch_conversation(agent, conv_id), new_ids)
+
+        for conv_id in new_ids:
+            # Бюджет проверяется до загрузки: без пула следующий разговор ещё не начат
+            if deadline is not None and time.monotonic() >= deadline:
+                # Ещё не начатые разговоры отменяются; high-water mark через них не пройдёт,
+                # а уже загруженное на Drive аудио возьмётся из кэша в следующий запуск
+                print(f"[{agent.name}] Время агента истекло, остальные разговоры — в следующий запуск.")
+                if executor is not None:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                break
+            if executor is not None:
+                entry = next(fetched)
+            else:
+                entry = fetch_conversation(agent, conv_id, drive_service)
+            if not entry:
+                store.mark_failed(conv_id, "fetch")
+                continue
+            if doc_batch:
+                pending_doc_entries.append((conv_id, entry))
+                continue
+            # Если запись в Doc не удалась, разговор не отмечается и будет повторён (аудио возьмётся из кэша)
+            if not append_doc_entry(docs_service, agent, entry):
+                store.mark_failed(conv_id, "doc")
+                continue
+            store.mark_processed([conv_id])
+            done_ids.add(conv_id)
+
+    if pending_doc_entries:
+        written_ids = write_doc_entries(docs_service, agent, pending_doc_entries)
+        store.mark_processed(written_ids)
+        done_ids.update(written_ids)
+
+def process_conversation_ids(agent, conversation_ids, docs_service, workers=None, doc_batch=None):
+    """
+    Обрабатывает конкретные разговоры агента (порция backfill, разговор из вебхука) без сдвига high-water mark.
+    Уже обработанные ID отбрасываются под блокировкой агента. Возвращает (new_ids, done_ids).
+    """
+    workers = workers or SYNC_WORKERS
+    doc_batch = DOC_BATCH_MODE if doc_batch is None else doc_batch
+    with agent_lock(agent):
+        # Хранилище открывается заново под блокировкой: другой процесс мог обработать часть разговоров
+        store = open_state_store(agent)
+        try:
+            new_ids = store.filter_new(list(conversation_ids))
+            done_ids = set(conversation_ids).difference(new_ids)
+            with agent_context(agent.name):
+                process_conversations(agent, new_ids, docs_service, None, workers, doc_batch, store, done_ids)
+        finally:
+            store.close()
+    return new_ids, done_ids
+
+def list_agent_conversations(agents):
+    """Список разговоров запрашиваем один раз и раздаём по агентам, начиная от самой старой отметки."""
+    marks = [listing_mark(agent) for agent in agents]
+    listed_at = int(time.time())
+    conversations_by_agent = get_elevenlabs_client().get_new_conversations(
+        [agent.agent_id for agent in agents], start_after=listing_start_after(marks)
+    )
+    note_listing_time(agents, listed_at)
+    return conversations_by_agent
+
+def process_agents_streaming(agents, docs_service, drive_service, workers=None, doc_batch=None, deadline=None):
+    """
+    Цикл по агентам из main, но список читается окнами (iter_conversation_windows) и каждое окно
+    обрабатывается сразу. Если в окне у агента остался необработанный разговор, его high-water mark
+    до конца запуска больше не сдвигается — как и при обработке всего списка за раз.
+    Блокировки и хранилища агентов открываются один раз на весь список, а не на каждое окно.
+    deadline — как в process_agent; после него следующие окна не читаются. Возвращает число новых записей.
+    """
+    workers = workers or SYNC_WORKERS
+    doc_batch = DOC_BATCH_MODE if doc_batch is None else doc_batch
+    marks = [listing_mark(agent) for agent in agents]
+    listed_at = int(time.time())
+    windows = get_elevenlabs_client().iter_conversation_windows(
+        [agent.agent_id for agent in agents], start_after=listing_start_after(marks)
+    )
+    held = set()
+    new_items = 0
+    with ExitStack() as stack:
+        stores = {}
+        for agent in agents:
+            stack.enter_context(agent_lock(agent))
+            stores[agent.name] = open_state_store(agent)
+            stack.callback(stores[agent.name].close)
+        for window in windows:
+            if deadline is not None and time.monotonic() >= deadline:
+                print(f"[{', '.join(agent.name for agent in agents)}] Время истекло, остаток списка — в следующий запуск.")
+                held.update(agent.name for agent in agents)
+                break
+            for agent in agents:
+                conversations = window.get(agent.agent_id)
+                if not conversations:
+                    continue
+                with agent_context(agent.name):
+                    new_items += _process_agent(
+                        agent, conversations, docs_service, drive_service, workers, doc_batch, stores[agent.name],
+                        deadline, save_mark=agent.name not in held,
+                    )
+                newest = conversations[-1].get("start_time_unix_secs", 0)
+                if load_agent_state(agent.state_file).get("high_water_mark", 0) < newest:
+                    held.add(agent.name)
+    # Список дочитан до конца: у агентов без пропусков он просмотрен на время начала запуска
+    for agent in agents:
+        if agent.name not in held:
+            note_listing_time([agent], listed_at)
+            save_high_water_mark(agent, [], set())
+    return new_items
+
+def main(agents=None, workers=None):
+    print("Начало работы скрипта...")
+    agents = load_agents_from_env() if agents is None else configured_agents(agents)
+    if not agents:
+        sys.exit("Не настроено ни одного агента.")
+
+    docs_service, drive_service = get_google_services()
+    if not all([docs_service, drive_service]):
+        sys.exit("Не удалось подключиться к сервисам Google.")
+
+    try:
+        if LISTING_STREAM:
+            process_agents_streaming(agents, docs_service, drive_service, workers)
+        else:
+            conversations_by_agent = list_agent_conversations(agents)
+            for agent in agents:
+                process_agent(agent, conversations_by_agent.get(agent.agent_id, []), docs_service, drive_service, workers)
+    except ListingError as e:
+        sys.exit(f"Не удалось получить список разговоров: {e}")
+
+    close_details_source()
+    run_report.finish_run()
+    print("Работа скрипта завершена.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from run_report import add_bytes, add_encode_seconds, add_source_bytes, instrumented
+
+# Перекодирование аудио перед загрузкой на Drive (SYNC_TRANSCODE):
+#   пусто — загружается исходный MP3 из ElevenLabs, как раньше;
+#   opus  — моно Opus в контейнере Ogg, для речи достаточно 16–32 кбит/с;
+#   mp3   — моно MP3 с битрейтом SYNC_TRANSCODE_BITRATE.
+# Кодирует ffmpeg (SYNC_FFMPEG) в отдельном процессе, не больше SYNC_TRANSCODE_WORKERS процессов сразу.
+# Аудио идёт через ffmpeg порциями: исходник читается из буфера или файла, результат пишется во временный
+# файл (в памяти до SYNC_AUDIO_SPOOL_MAX_BYTES, как и при скачивании) — запись целиком в память не попадает.
+# Если ffmpeg нет, он завершился с ошибкой или результат не меньше исходного — загружается исходный файл.
+TRANSCODE_CODEC = os.getenv('SYNC_TRANSCODE', '')
+TRANSCODE_BITRATE = os.getenv('SYNC_TRANSCODE_BITRATE', '24k')
+TRANSCODE_WORKERS = int(os.getenv('SYNC_TRANSCODE_WORKERS', '0')) or os.cpu_count() or 1
+TRANSCODE_TIMEOUT = float(os.getenv('SYNC_TRANSCODE_TIMEOUT', '300'))
+TRANSCODE_SPOOL_MAX_BYTES = int(os.getenv('SYNC_AUDIO_SPOOL_MAX_BYTES', str(32 * 1024 * 1024)))
+TRANSCODE_CHUNK_SIZE = 1024 * 1024
+FFMPEG = os.getenv('SYNC_FFMPEG', 'ffmpeg')
+
+SOURCE_EXTENSION = '.mp3'
+SOURCE_MIME_TYPE = 'audio/mpeg'
+
+# Кодек -> (кодировщик ffmpeg, формат контейнера, расширение файла, mimeType для Drive)
+CODECS = {
+    'opus': ('libopus', 'ogg', '.ogg', 'audio/ogg'),
+    'mp3': ('libmp3lame', 'mp3', '.mp3', 'audio/mpeg'),
+}
+if TRANSCODE_CODEC and TRANSCODE_CODEC not in CODECS:
+    raise ValueError(f"Неизвестный кодек для перекодирования аудио: {TRANSCODE_CODEC}")
+
+AUDIO_EXTENSIONS = tuple(sorted({SOURCE_EXTENSION} | {ext for _, _, ext, _ in CODECS.values()}))
+
+
+class TranscodeError(Exception):
+    pass
+
+
+@dataclass
+class TranscodedAudio:
+    file: Any  # временный файл с результатом, перемотанный в начало
+    size: int
+    extension: str
+    mime_type: str
+    source_bytes: int
+    encode_seconds: float
+
+    def close(self):
+        self.file.close()
+
+
+def ffmpeg_command(codec, bitrate):
+    encoder, container, _, _ = CODECS[codec]
+    command = [FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-vn', '-ac', '1',
+               '-c:a', encoder, '-b:a', bitrate]
+    if codec == 'opus':
+        command += ['-application', 'voip']
+    return command + ['-f', container, 'pipe:1']
+
+
+def _feed(audio, stdin, progress):
+    """Поток-писатель: отдаёт аудио (буфер или путь к файлу) в stdin ffmpeg порциями."""
+    try:
+        source = open(audio, 'rb') if isinstance(audio, str) else audio
+        try:
+            source.seek(0)
+            for chunk in iter(lambda: source.read(TRANSCODE_CHUNK_SIZE), b''):
+                stdin.write(chunk)
+                progress['written'] += len(chunk)
+        finally:
+            if source is not audio:
+                source.close()
+    except Exception as e:
+        # В том числе BrokenPipeError: ffmpeg завершился, не дочитав вход
+        progress['error'] = e
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def encode(audio, codec, bitrate, timeout=TRANSCODE_TIMEOUT):
+    """
+    Пропускает аудио через ffmpeg, не читая его в память целиком.
+    Возвращает (временный файл с результатом, байт на входе, секунды кодирования).
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=TRANSCODE_SPOOL_MAX_BYTES)
+    with tempfile.TemporaryFile() as stderr:
+        try:
+            process = subprocess.Popen(
+                ffmpeg_command(codec, bitrate), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr,
+            )
+        except OSError as e:
+            output.close()
+            raise TranscodeError(str(e)) from None
+        progress = {'written': 0, 'error': None}
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        writer = threading.Thread(target=_feed, args=(audio, process.stdin, progress), name="ffmpeg-feed", daemon=True)
+        timer = threading.Timer(timeout, kill)
+        started = time.perf_counter()
+        writer.start()
+        timer.start()
+        try:
+            for chunk in iter(lambda: process.stdout.read(TRANSCODE_CHUNK_SIZE), b''):
+                output.write(chunk)
+            returncode = process.wait()
+            writer.join()
+        except BaseException:
+            process.kill()
+            process.wait()
+            output.close()
+            raise
+        finally:
+            timer.cancel()
+            process.stdout.close()
+        seconds = time.perf_counter() - started
+
+        error = None
+        if timed_out.is_set():
+            error = f"ffmpeg не уложился в {timeout:.0f} с"
+        elif returncode != 0:
+            stderr.seek(0)
+            error = stderr.read().decode(errors='replace').strip() or f"код {returncode}"
+        elif progress['error'] is not None:
+            error = f"не удалось передать аудио в ffmpeg: {progress['error']!r}"
+        elif not output.tell():
+            error = "ffmpeg не вернул данных"
+        if error:
+            output.close()
+            raise TranscodeError(error)
+    output.seek(0)
+    return output, progress['written'], seconds
+
+
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(TRANSCODE_WORKERS)
+_ffmpeg_found = None
+
+
+def transcoding_enabled():
+    """Включено ли перекодирование и есть ли ffmpeg (об отсутствии сообщается один раз)."""
+    global _ffmpeg_found
+    if not TRANSCODE_CODEC:
+        return False
+    with _lock:
+        if _ffmpeg_found is None:
+            _ffmpeg_found = shutil.which(FFMPEG) is not None
+            if not _ffmpeg_found:
+                print(f"Перекодирование аудио выключено: не найден {FFMPEG}.")
+    return _ffmpeg_found
+
+
+@instrumented('transcode')
+def transcode_audio(audio, codec=None, bitrate=None):
+    """
+    Перекодирует аудио (буфер или путь к файлу). Возвращает TranscodedAudio, который нужно закрыть
+    после загрузки, или None, если нужно загрузить исходный файл; исходный буфер остаётся перемотанным
+    в начало. В отчёт о запуске идут размеры до и после и время кодирования.
+    """
+    codec = codec or TRANSCODE_CODEC
+    bitrate = bitrate or TRANSCODE_BITRATE
+    try:
+        with _slots:
+            encoded, source_bytes, seconds = encode(audio, codec, bitrate)
+    except Exception as e:
+        print(f"Не удалось перекодировать аудио в {codec}: {e}. Загружаем исходный файл.")
+        return None
+    finally:
+        if not isinstance(audio, str):
+            audio.seek(0)
+    size = encoded.seek(0, os.SEEK_END)
+    encoded.seek(0)
+    if size >= source_bytes:
+        encoded.close()
+        print(f"Перекодированное аудио не меньше исходного ({size} >= {source_bytes} байт). Загружаем исходный файл.")
+        return None
+    add_source_bytes(source_bytes)
+    add_bytes(size)
+    add_encode_seconds(seconds)
+    _, _, extension, mime_type = CODECS[codec]
+    return TranscodedAudio(encoded, size, extension, mime_type, source_bytes, seconds)
@@ -0,0 +1,484 @@
+"""
+Постоянная очередь работ (SQLite): поиск новых разговоров отделён от их доставки в Drive и Google Doc.
+
+    python work_queue.py enqueue                 # найти новые разговоры и поставить их в очередь (cron)
+    python work_queue.py work --workers 4        # обрабатывать очередь; можно запускать несколько процессов
+    python work_queue.py work --drain            # обработать всё, что есть, и выйти
+    python work_queue.py stats
+    python work_queue.py requeue                 # вернуть разговоры из dead letter на этап, где они упали
+
+Разговор проходит этапы details -> audio (скачивание и загрузка на Drive) -> append -> done.
+Детали, полученные на этапе details, хранятся в строке очереди до записи в Doc, так что этап append
+не обращается к API ElevenLabs повторно и не зависит от дискового кэша деталей.
+Этапы details и audio берутся рабочими потоками с арендой на SYNC_QUEUE_VISIBILITY_TIMEOUT секунд:
+если процесс умер, разговор по истечении аренды достанется другому. Неудача откладывает разговор
+с экспоненциальной паузой; после SYNC_QUEUE_MAX_ATTEMPTS попыток на одном этапе он уходит в dead.
+
+Запись в Doc (append) выполняется под блокировкой агента (state_store.agent_lock), в хронологическом
+порядке; перед записью уже обработанные ID отбрасываются по хранилищу состояния, а после записи
+разговор отмечается там же — поэтому ни несколько процессов очереди, ни параллельный cron-запуск
+sync_engine не запишут разговор в Doc дважды.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from elevenlabs_client import ListingError
+import run_report
+from run_report import agent_context
+from state_store import agent_lock, open_state_store
+from sync_engine import (
+    AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES, AUDIO_STREAMING, DOC_BATCH_MODE, append_doc_entry, close_details_source,
+    get_details_source, get_elevenlabs_client, get_google_services, get_thread_drive_service, known_audio_link, list_agent_conversations,
+    load_agents_from_env, make_entry, save_high_water_mark, select_new_conversations, upload_audio, write_doc_entries,
+)
+
+QUEUE_DB_PATH = os.getenv('SYNC_QUEUE_DB', 'work_queue.sqlite3')
+QUEUE_VISIBILITY_TIMEOUT = float(os.getenv('SYNC_QUEUE_VISIBILITY_TIMEOUT', '900'))
+QUEUE_MAX_ATTEMPTS = int(os.getenv('SYNC_QUEUE_MAX_ATTEMPTS', '5'))
+QUEUE_RETRY_BASE_DELAY = float(os.getenv('SYNC_QUEUE_RETRY_BASE_DELAY', '30'))
+QUEUE_POLL_INTERVAL = float(os.getenv('SYNC_QUEUE_POLL_INTERVAL', '2'))
+
+STAGE_DETAILS = 'details'
+STAGE_AUDIO = 'audio'
+STAGE_APPEND = 'append'
+STAGE_DONE = 'done'
+STAGE_DEAD = 'dead'
+WORKER_STAGES = (STAGE_DETAILS, STAGE_AUDIO)
+NEXT_STAGE = {STAGE_DETAILS: STAGE_AUDIO, STAGE_AUDIO: STAGE_APPEND, STAGE_APPEND: STAGE_DONE}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    conversation_id TEXT PRIMARY KEY,
+    agent_id TEXT NOT NULL,
+    start_time_unix_secs INTEGER NOT NULL DEFAULT 0,
+    stage TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed_stage TEXT,
+    last_error TEXT,
+    audio_link TEXT,
+    listing TEXT,
+    details TEXT,
+    lease_owner TEXT,
+    lease_expires REAL,
+    available_at REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (stage, available_at, start_time_unix_secs);
+CREATE INDEX IF NOT EXISTS jobs_agent ON jobs (agent_id, stage, start_time_unix_secs);
+'''
+
+_JOB_COLUMNS = 'conversation_id, agent_id, start_time_unix_secs, stage, attempts, audio_link, listing, details'
+
+
+@dataclass
+class Job:
+    conversation_id: str
+    agent_id: str
+    start_time_unix_secs: int
+    stage: str
+    attempts: int
+    audio_link: str = None
+    listing: str = None
+    details: str = None
+
+
+class WorkQueue:
+    def __init__(self, path=None, visibility_timeout=QUEUE_VISIBILITY_TIMEOUT, max_attempts=QUEUE_MAX_ATTEMPTS,
+                 retry_base_delay=QUEUE_RETRY_BASE_DELAY):
+        self.path = path or QUEUE_DB_PATH
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        # Одно соединение на процесс, обращения рабочих потоков — под блокировкой;
+        # процессы очереди разделяют файл через блокировки SQLite (ожидание до 30 с)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')}
+        if 'details' not in columns:
+            # Очередь, созданная до хранения деталей в строке
+            with self.conn:
+                self.conn.execute('ALTER TABLE jobs ADD COLUMN details TEXT')
+        self.lock = threading.Lock()
+
+    def enqueue(self, agent_id, conversations):
+        """Ставит разговоры в очередь (уже стоящие не трогаются). Возвращает число добавленных."""
+        now = time.time()
+        rows = [
+            (conv['conversation_id'], agent_id, conv.get('start_time_unix_secs') or 0, STAGE_DETAILS,
+             json.dumps(conv, ensure_ascii=False), now, now, now)
+            for conv in conversations if conv.get('conversation_id')
+        ]
+        with self.lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO jobs (conversation_id, agent_id, start_time_unix_secs, stage, listing, '
+                'available_at, enqueued_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows,
+            )
+            return self.conn.total_changes - before
+
+    def claim(self, owner, agent_ids, stages=WORKER_STAGES):
+        """
+        Берёт в аренду самый старый готовый разговор агентов agent_ids на одном из этапов stages. Истёкшая
+        аренда (процесс умер или завис) считается неудачной попыткой, чтобы «ядовитый» разговор ушёл в dead.
+        """
+        now = time.time()
+        placeholders = ', '.join('?' for _ in stages)
+        agent_placeholders = ', '.join('?' for _ in agent_ids)
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                f'UPDATE jobs SET lease_owner = ?, lease_expires = ?, updated_at = ?, '
+                f'attempts = attempts + (lease_owner IS NOT NULL) '
+                f'WHERE conversation_id = ('
+                f'  SELECT conversation_id FROM jobs WHERE stage IN ({placeholders}) AND agent_id IN ({agent_placeholders}) '
+                f'  AND available_at <= ? AND (lease_expires IS NULL OR lease_expires < ?) '
+                f'  ORDER BY start_time_unix_secs LIMIT 1'
+                f') RETURNING {_JOB_COLUMNS}',
+                (owner, now + self.visibility_timeout, now, *stages, *agent_ids, now, now),
+            ).fetchone()
+        if row is None:
+            return None
+        job = Job(*row)
+        if job.attempts >= self.max_attempts:
+            self._dead_letter(job, "аренда истекла слишком много раз")
+            return self.claim(owner, agent_ids, stages)
+        return job
+
+    def advance(self, job, owner=None, audio_link=None, details=None):
+        """
+        Переводит разговор на следующий этап. False — аренду уже забрал другой процесс.
+        Детали хранятся в строке до записи в Doc; записанному разговору они больше не нужны.
+        """
+        now = time.time()
+        stage = NEXT_STAGE[job.stage]
+        details = json.dumps(details, ensure_ascii=False) if details else None
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                'UPDATE jobs SET stage = ?, attempts = 0, last_error = NULL, lease_owner = NULL, lease_expires = NULL, '
+                'audio_link = COALESCE(?, audio_link), details = CASE WHEN ? = ? THEN NULL ELSE COALESCE(?, details) END, '
+                'available_at = ?, updated_at = ? '
+                'WHERE conversation_id = ? AND stage = ? AND (? IS NULL OR lease_owner = ?)',
+                (stage, audio_link, stage, STAGE_DONE, details, now, now, job.conversation_id, job.stage, owner, owner),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, job, error, owner=None):
+        """Неудачная попытка: пауза base * 2^попытка или dead letter после max_attempts."""
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            return self._dead_letter(job, error, owner)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE jobs SET attempts = ?, last_error = ?, lease_owner = NULL, lease_expires = NULL, '
+                'available_at = ?, updated_at = ? WHERE conversation_id = ? AND stage = ? AND (? IS NULL OR lease_owner = ?)',
+                (attempts, str(error), now + self.retry_base_delay * 2 ** job.attempts, now,
+                 job.conversation_id, job.stage, owner, owner),
+            )
+
+    def _dead_letter(self, job, error, owner=None):
+        now = time.time()
+        print(f"Разговор {job.conversation_id} отправлен в dead letter на этапе {job.stage}: {error}")
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE jobs SET stage = ?, failed_stage = ?, attempts = ?, last_error = ?, lease_owner = NULL, '
+                'lease_expires = NULL, updated_at = ? WHERE conversation_id = ? AND stage = ? '
+                'AND (? IS NULL OR lease_owner = ?)',
+                (STAGE_DEAD, job.stage, max(job.attempts + 1, self.max_attempts), str(error), now,
+                 job.conversation_id, job.stage, owner, owner),
+            )
+
+    def ready_for_append(self, agent_id):
+        """
+        Разговоры агента, готовые к записи в Doc, по времени. Запись не обгоняет более ранние разговоры,
+        которые ещё не пытались обработать или обрабатываются в первый раз; упавшие (ждут повтора)
+        не задерживают остальные — как и в sync_engine, они будут записаны позже.
+        """
+        now = time.time()
+        placeholders = ', '.join('?' for _ in WORKER_STAGES)
+        with self.lock:
+            barrier = self.conn.execute(
+                f'SELECT MIN(start_time_unix_secs) FROM jobs WHERE agent_id = ? AND stage IN ({placeholders}) '
+                f'AND attempts = 0',
+                (agent_id, *WORKER_STAGES),
+            ).fetchone()[0]
+            rows = self.conn.execute(
+                f'SELECT {_JOB_COLUMNS} FROM jobs WHERE agent_id = ? AND stage = ? AND available_at <= ? '
+                f'AND (? IS NULL OR start_time_unix_secs < ?) ORDER BY start_time_unix_secs',
+                (agent_id, STAGE_APPEND, now, barrier, barrier),
+            ).fetchall()
+        return [Job(*row) for row in rows]
+
+    def requeue_dead(self, agent_id=None):
+        now = time.time()
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                'UPDATE jobs SET stage = failed_stage, failed_stage = NULL, attempts = 0, available_at = ?, '
+                'updated_at = ? WHERE stage = ? AND (? IS NULL OR agent_id = ?)',
+                (now, now, STAGE_DEAD, agent_id, agent_id),
+            )
+            return cursor.rowcount
+
+    def pending(self):
+        """Число разговоров, которые ещё не записаны и не в dead letter."""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE stage NOT IN (?, ?)', (STAGE_DONE, STAGE_DEAD),
+            ).fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT agent_id, stage, COUNT(*), SUM(lease_expires > ?), SUM(attempts > 0) FROM jobs '
+                'GROUP BY agent_id, stage ORDER BY agent_id, stage',
+                (time.time(),),
+            ).fetchall()
+        return rows
+
+    def close(self):
+        self.conn.close()
+
+
+# --- Обработка ---
+
+def _worker_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def run_stage(job, agent):
+    """
+    Один этап details или audio. Возвращает (успех, результат): детали разговора или ссылку на аудио,
+    при неудаче — текст ошибки.
+    """
+    if job.stage == STAGE_DETAILS:
+        if job.listing:
+            get_details_source().remember_listing([json.loads(job.listing)])
+        details = get_details_source().get(job.conversation_id)
+        if not details:
+            return False, "не удалось получить детали"
+        return True, details
+
+    audio_link = known_audio_link(agent, job.conversation_id)
+    if audio_link:
+        return True, audio_link
+    client = get_elevenlabs_client()
+    if AUDIO_STREAMING:
+        audio = client.download_conversation_audio_stream(job.conversation_id, AUDIO_CHUNK_SIZE, AUDIO_SPOOL_MAX_BYTES)
+    else:
+        audio = client.download_conversation_audio(job.conversation_id)
+    if not audio:
+        return False, "не удалось скачать аудио"
+    try:
+        audio_link = upload_audio(get_thread_drive_service(), audio, job.conversation_id, agent.drive_folder_id)
+    finally:
+        if AUDIO_STREAMING:
+            audio.close()
+        else:
+            os.remove(audio)
+    if not audio_link:
+        return False, "не удалось загрузить аудио на Drive"
+    return True, audio_link
+
+
+def append_ready(queue, agent, docs_service, doc_batch=False):
+    """Записывает в Doc готовые разговоры агента. Возвращает число записанных."""
+    with agent_lock(agent):
+        jobs = queue.ready_for_append(agent.agent_id)
+        if not jobs:
+            return 0
+        store = open_state_store(agent)
+        try:
+            new_ids = set(store.filter_new([job.conversation_id for job in jobs]))
+            pending = []
+            written = 0
+            with agent_context(agent.name):
+                for job in jobs:
+                    if job.conversation_id not in new_ids:
+                        # Уже записан (например, cron-запуском sync_engine)
+                        queue.advance(job)
+                        continue
+                    if job.details:
+                        details = json.loads(job.details)
+                    else:
+                        # Разговор прошёл этап details до того, как детали стали храниться в очереди
+                        details = get_details_source().get(job.conversation_id)
+                    if not details:
+                        store.mark_failed(job.conversation_id, "details")
+                        queue.fail(job, "не удалось получить детали")
+                        continue
+                    entry = make_entry(agent, details, job.audio_link)
+                    if doc_batch:
+                        pending.append((job, entry))
+                        continue
+                    if not append_doc_entry(docs_service, agent, entry):
+                        store.mark_failed(job.conversation_id, "doc")
+                        queue.fail(job, "ошибка записи в Google Doc")
+                        continue
+                    store.mark_processed([job.conversation_id])
+                    queue.advance(job)
+                    written += 1
+                if pending:
+                    written_ids = set(write_doc_entries(
+                        docs_service, agent, [(job.conversation_id, entry) for job, entry in pending],
+                    ))
+                    store.mark_processed([job.conversation_id for job, _ in pending if job.conversation_id in written_ids])
+                    for job, _ in pending:
+                        if job.conversation_id in written_ids:
+                            queue.advance(job)
+                            written += 1
+                        else:
+                            store.mark_failed(job.conversation_id, "doc")
+                            queue.fail(job, "ошибка записи в Google Doc")
+            return written
+        finally:
+            store.close()
+
+
+class QueueWorker:
+    def __init__(self, queue, agents, docs_service, workers=1, doc_batch=False, poll_interval=QUEUE_POLL_INTERVAL):
+        self.queue = queue
+        self.agents_by_id = {agent.agent_id: agent for agent in agents}
+        self.docs_service = docs_service
+        self.workers = max(workers, 1)
+        self.doc_batch = doc_batch
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        self.busy = 0
+        self.busy_lock = threading.Lock()
+
+    def _work(self):
+        owner = _worker_owner()
+        while not self.stopping.is_set():
+            job = self.queue.claim(owner, list(self.agents_by_id))
+            if job is None:
+                self.stopping.wait(self.poll_interval)
+                continue
+            agent = self.agents_by_id[job.agent_id]
+            with self.busy_lock:
+                self.busy += 1
+            try:
+                with agent_context(agent.name):
+                    try:
+                        ok, result = run_stage(job, agent)
+                    except Exception as e:
+                        ok, result = False, repr(e)
+                if ok and job.stage == STAGE_DETAILS:
+                    self.queue.advance(job, owner, details=result)
+                elif ok:
+                    self.queue.advance(job, owner, audio_link=result)
+                else:
+                    print(f"[{agent.name}] {job.conversation_id}, этап {job.stage}: {result}")
+                    self.queue.fail(job, result, owner)
+            finally:
+                with self.busy_lock:
+                    self.busy -= 1
+
+    def run(self, drain=False):
+        threads = [
+            threading.Thread(target=self._work, name=f"queue-worker-{i}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while not self.stopping.is_set():
+                written = sum(
+                    append_ready(self.queue, agent, self.docs_service, self.doc_batch)
+                    for agent in self.agents_by_id.values()
+                )
+                if drain and not written and not self.busy and not self.queue.pending():
+                    break
+                if not written:
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        self.stopping.set()
+
+
+def discover(queue, agents):
+    """Находит новые разговоры и ставит их в очередь. High-water mark сдвигается и по поставленным."""
+    conversations_by_agent = list_agent_conversations(agents)
+    total = 0
+    for agent in agents:
+        conversations = conversations_by_agent.get(agent.agent_id, [])
+        with agent_lock(agent):
+            store = open_state_store(agent)
+            try:
+                new_ids, done_ids = select_new_conversations(agent, conversations, store)
+            finally:
+                store.close()
+            new_set = set(new_ids)
+            added = queue.enqueue(agent.agent_id, [conv for conv in conversations if conv.get('conversation_id') in new_set])
+            # Разговор в очереди не потеряется, поэтому отметка может пройти через него
+            save_high_water_mark(agent, conversations, done_ids | new_set)
+        print(f"[{agent.name}] В очередь добавлено {added} разговоров (новых в списке: {len(new_ids)}).")
+        total += added
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=QUEUE_DB_PATH, help="файл очереди (по умолчанию SYNC_QUEUE_DB)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('enqueue', help="поставить новые разговоры в очередь")
+    work = commands.add_parser('work', help="обрабатывать очередь")
+    work.add_argument('--workers', type=int, default=int(os.getenv('SYNC_WORKERS', '1')))
+    work.add_argument('--drain', action='store_true', help="выйти, когда очередь опустеет")
+    work.add_argument('--doc-batch', action='store_true', help="писать в Doc пачками batchUpdate")
+    commands.add_parser('stats', help="состояние очереди")
+    requeue = commands.add_parser('requeue', help="вернуть разговоры из dead letter")
+    requeue.add_argument('--agent-id')
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.db)
+    try:
+        if args.command == 'stats':
+            totals = Counter()
+            for agent_id, stage, count, leased, retrying in queue.stats():
+                totals[stage] += count
+                print(f"{agent_id}  {stage:<8}{count:>8}  в работе {leased or 0}, с повторами {retrying or 0}")
+            print("Всего: " + ", ".join(f"{stage} {count}" for stage, count in sorted(totals.items())))
+            return
+        if args.command == 'requeue':
+            print(f"Возвращено из dead letter: {queue.requeue_dead(args.agent_id)}.")
+            return
+
+        agents = load_agents_from_env()
+        if not agents:
+            sys.exit("Не настроено ни одного агента.")
+        if args.command == 'enqueue':
+            try:
+                discover(queue, agents)
+            except ListingError as e:
+                sys.exit(f"Не удалось получить список разговоров: {e}")
+            return
+
+        docs_service, drive_service = get_google_services()
+        if not all([docs_service, drive_service]):
+            sys.exit("Не удалось подключиться к сервисам Google.")
+        worker = QueueWorker(queue, agents, docs_service, args.workers, args.doc_batch or DOC_BATCH_MODE)
+        try:
+            worker.run(drain=args.drain)
+        except KeyboardInterrupt:
+            worker.stop()
+        close_details_source()
+        run_report.finish_run()
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()